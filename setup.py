@@ -29,7 +29,9 @@ setuptools.setup(
         "Framework :: Django",
     ],
     package_dir={"": "src"},
-    package_data={"twilio_call_center": ["templates/*/*.html"]},
+    package_data={"twilio_call_center": ["templates/*/*.html",
+                                         "templates/*/*.txt",
+                                         "benchmark_baseline.json"]},
     packages=setuptools.find_packages(where="src"),
     python_requires=">=3.6",
 )
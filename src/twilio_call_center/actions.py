@@ -0,0 +1,274 @@
+''' Caching and timeouts for the configured action functions.
+
+A function is given a policy as the third element of its tuple in
+TWILIO_CALL_CENTER_ACTION_FUNCTIONS, the keys are described in policy_defaults.
+'''
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+from importlib import import_module
+from twilio.twiml.voice_response import VoiceResponse
+
+from .cache import shared_cache
+from .instrumentation import count_action
+
+
+logger = logging.getLogger(__name__)
+
+policy_defaults = {
+    # seconds to keep the returned string, None does not cache
+    'cache': None,
+    # the request fields which the returned string depends on
+    'cache_key': ['From'],
+    # seconds to wait for the function, None waits until it returns
+    'timeout': None,
+    # what to say when the function did not return in time
+    'fallback': 'Sorry, this is not available right now',
+    # put the caller on hold while the function runs, see start()
+    'background': False,
+    # what to say when the caller is put on hold
+    'hold': 'Please hold',
+    # seconds between the checks for the background result
+    'poll': 5,
+}
+
+action_workers = 10
+# how long the state of a background call is kept in the cache
+background_state_seconds = 60 * 60
+
+_missing = object()
+# the background result is not ready yet
+pending = object()
+# no background function was started for the call and digit
+not_started = object()
+
+_executor_lock = threading.Lock()
+_executor = None
+
+
+def get_action_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=action_workers,
+                                           thread_name_prefix='twilio_action')
+        return _executor
+
+
+def check_policy(name, policy):
+    unknown = set(policy) - set(policy_defaults)
+    if unknown:
+        raise ImproperlyConfigured(
+                "Unknown policy {} for action function {}".format(
+                    ', '.join(sorted(unknown)), name))
+    for key in ['cache', 'timeout', 'poll']:
+        value = policy.get(key, None)
+        if value is not None and value <= 0:
+            raise ImproperlyConfigured(
+                    "The {} of action function {} must be greater than "
+                    "0".format(key, name))
+
+
+def action_function(name, func, policy=None):
+    ''' Returns func with the policy applied, or func itself when there is
+    no policy.'''
+    if not policy:
+        return func
+    check_policy(name, policy)
+    return ActionFunction(name, func, dict(policy_defaults, **policy))
+
+
+class LazyActionFunctions(Mapping):
+    ''' The configured action functions by name. The module of a function is
+    imported when the function is first used, listing the names does not
+    import anything.
+
+    A function which cannot be loaded is logged once, then replaced by one
+    saying the fallback phrase, so a call never fails on it.'''
+
+    def __init__(self, entries):
+        self._lock = threading.Lock()
+        self._entries = {}
+        # one lock per name, so a slow import only holds up its own name
+        self._load_locks = {}
+        self._loaded = {}
+        self._errors = {}
+        for module, func, *policy in entries:
+            name = module + '.' + func
+            policy = policy[0] if policy else None
+            if policy:
+                check_policy(name, policy)
+            self._entries[name] = (module, func, policy)
+            self._load_locks[name] = threading.Lock()
+
+    def load(self, name):
+        module, func, policy = self._entries[name]
+        try:
+            target = getattr(import_module(module), func)
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+        else:
+            if callable(target):
+                return action_function(name, target, policy)
+            error = 'Not callable'
+        with self._lock:
+            self._errors[name] = error
+        logger.error("Could not load action function {}, {}".format(
+            name, error))
+        fallback = dict(policy_defaults, **(policy or {}))['fallback']
+        return lambda **kwargs: fallback
+
+    def __getitem__(self, name):
+        func = self._loaded.get(name, _missing)
+        if func is not _missing:
+            return func
+        with self._load_locks[name]:
+            if name not in self._loaded:
+                self._loaded[name] = self.load(name)
+            return self._loaded[name]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def check(self):
+        ''' Loads every function, returns {name: error} for the ones which
+        could not be loaded or are not callable.'''
+        for name in self:
+            self[name]
+        with self._lock:
+            return dict(self._errors)
+
+
+class ActionFunction:
+    ''' Called like the action function it wraps.
+
+    Only the returned string is cached, so a cached function should not add
+    to the response itself. With a timeout the function runs in a thread,
+    and the verbs it adds to the response are only kept when it returns in
+    time.'''
+
+    def __init__(self, name, func, policy):
+        self.name = name
+        self.func = func
+        self.policy = policy
+
+    @property
+    def background(self):
+        return self.policy['background']
+
+    def cache_key(self, request):
+        data = request.POST if request.method == 'POST' else request.GET
+        fields = [data.get(field, None) for field in self.policy['cache_key']]
+        digest = hashlib.sha1(json.dumps([self.name, fields]).encode())
+        return 'twilio_call_center:action:' + digest.hexdigest()
+
+    def cached(self, request):
+        ''' Returns the cached result for the request, or _missing.'''
+        if self.policy['cache'] is None:
+            return _missing
+        result = shared_cache().get(self.cache_key(request), _missing)
+        if result is _missing:
+            count_action(self.name, 'cache_misses_total')
+        else:
+            count_action(self.name, 'cache_hits_total')
+        return result
+
+    def __call__(self, request, response):
+        if self.policy['cache'] is None:
+            return self.call(request, response)[0]
+
+        result = self.cached(request)
+        if result is not _missing:
+            return result
+        result, timed_out = self.call(request, response)
+        if not timed_out:
+            shared_cache().set(self.cache_key(request), result,
+                               timeout=self.policy['cache'])
+        return result
+
+    def call(self, request, response):
+        ''' Returns the result and whether the function timed out.'''
+        if self.policy['timeout'] is None:
+            return self.func(request=request, response=response), False
+
+        scratch = VoiceResponse()
+        future = get_action_executor().submit(self.run, request, scratch)
+        try:
+            result = future.result(timeout=self.policy['timeout'])
+        except TimeoutError:
+            count_action(self.name, 'timeouts_total')
+            logger.warning("Action function {} timed out after {} "
+                           "seconds".format(self.name, self.policy['timeout']))
+            return self.policy['fallback'], True
+        response.verbs.extend(scratch.verbs)
+        return result, False
+
+    def run(self, request, response):
+        try:
+            return self.func(request=request, response=response)
+        finally:
+            close_old_connections()
+
+    def state_key(self, request, digit):
+        data = request.POST if request.method == 'POST' else request.GET
+        return 'twilio_call_center:action-state:{}:{}:{}'.format(
+                self.name, data.get('CallSid', ''), digit)
+
+    def start(self, request, digit):
+        ''' Starts the function in the background for the call. Returns the
+        cached result, or pending when the caller has to wait for poll().
+
+        Only the returned string is used, the verbs the function adds to the
+        response are dropped. The state is kept in the shared django cache,
+        so any process can answer the poll.'''
+        result = self.cached(request)
+        if result is not _missing:
+            return result
+        key = self.state_key(request, digit)
+        shared_cache().set(key, dict(done=False, started=time.time()),
+                           timeout=background_state_seconds)
+        get_action_executor().submit(self.run_background, request, key)
+        return pending
+
+    def run_background(self, request, key):
+        try:
+            result = self.run(request, VoiceResponse())
+        except Exception as e:
+            logger.error("Action function {} failed".format(self.name))
+            logger.error(str(e))
+            result = self.policy['fallback']
+        else:
+            if self.policy['cache'] is not None:
+                shared_cache().set(self.cache_key(request), result,
+                                   timeout=self.policy['cache'])
+        shared_cache().set(key, dict(done=True, result=result),
+                           timeout=background_state_seconds)
+
+    def poll(self, request, digit):
+        ''' Returns the result started by start() for the call and digit,
+        pending while it runs, or the fallback after the timeout. Returns
+        not_started when start() was not called for them.'''
+        cache = shared_cache()
+        key = self.state_key(request, digit)
+        state = cache.get(key)
+        if state is None:
+            return not_started
+        if state['done']:
+            cache.delete(key)
+            return state['result']
+        timeout = self.policy['timeout']
+        if timeout is not None and time.time() - state['started'] > timeout:
+            count_action(self.name, 'timeouts_total')
+            cache.delete(key)
+            return self.policy['fallback']
+        return pending
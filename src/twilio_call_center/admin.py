@@ -1,13 +1,18 @@
 from django import forms
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.sites.shortcuts import get_current_site
+from django.db.models import Count, Q
 from django.urls import reverse
 from django.utils.html import format_html
 
 from .apps import my_app
+from .campaigns import add_recipients, pause_campaign, read_recipients_csv, \
+    start_campaign
+from .history import twilio_number_filter
 from .models import Menu, MenuItem, Voice, Voicemail, MailboxNumber, \
-        SmsMessage, TwilioNumber
-from .utils import parse_phone_number
-from .views import call_reverse, get_query_dict
+        Notification, SmsCampaign, SmsCampaignRecipient, SmsMessage, \
+        TwilioNumber
+from .views import call_reverse, get_query_dict, twilio_callback_site
 
 
 def link_to_object(member, model=None):
@@ -193,15 +198,7 @@ class TwilioNumberListFilter(admin.SimpleListFilter):
         number = TwilioNumber.objects.filter(pk=int(self.value())).first()
         if number is None:
             return
-        phone_number = parse_phone_number(number.phone)
-
-        matching_pks = []
-        for n in queryset:
-            if phone_number == parse_phone_number(n.to_phone) or \
-                    phone_number == parse_phone_number(n.from_phone):
-                matching_pks.append(n.pk)
-
-        return queryset.filter(pk__in=matching_pks)
+        return queryset.filter(twilio_number_filter(number))
 
 
 class SmsMessageAdmin(admin.ModelAdmin):
@@ -215,10 +212,105 @@ class SmsMessageAdmin(admin.ModelAdmin):
         return False
 
 
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'status', 'attempts', 'created', 'next_attempt',
+                    'last_error']
+    list_display_links = list_display
+    list_filter = ['kind', 'status']
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class SmsCampaignAdminForm(forms.ModelForm):
+    recipients_csv = forms.FileField(
+            help_text='A CSV file with a phone column. The other columns ' +
+                'can be used in the message. Adds to the recipients.',
+            required=False)
+
+    class Meta:
+        model = SmsCampaign
+        fields = ['name', 'twilio_number', 'body']
+
+    def clean_recipients_csv(self):
+        csv_file = self.cleaned_data['recipients_csv']
+        if csv_file:
+            try:
+                next(read_recipients_csv(csv_file), None)
+            except (UnicodeDecodeError, ValueError) as e:
+                raise forms.ValidationError(str(e))
+            csv_file.seek(0)
+        return csv_file
+
+
+class SmsCampaignAdmin(admin.ModelAdmin):
+    form = SmsCampaignAdminForm
+    list_display = ['name', link_to_object('twilio_number', 'twilionumber'),
+                    'status', 'progress', 'last_activity']
+    list_display_links = ['name']
+    list_filter = ['status']
+    readonly_fields = ['status', 'progress', 'created', 'last_activity']
+    actions = ['start_sending', 'pause_sending']
+
+    def get_queryset(self, request):
+        recipient_count = lambda status: Count(
+                'recipients', filter=Q(recipients__status=status))
+        return super().get_queryset(request).annotate(
+                pending=recipient_count(SmsCampaignRecipient.PENDING),
+                sent=recipient_count(SmsCampaignRecipient.SENT),
+                failed=recipient_count(SmsCampaignRecipient.FAILED))
+
+    def progress(self, obj):
+        if obj.pk is None:
+            return '-'
+        link = reverse(
+                "admin:twilio_call_center_smscampaignrecipient_changelist") + \
+            "?campaign__id__exact={}".format(obj.pk)
+        return format_html('<a href="{}">{} sent, {} failed, {} pending</a>',
+                           link, obj.sent, obj.failed, obj.pending)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        csv_file = form.cleaned_data.get('recipients_csv')
+        if csv_file:
+            added, invalid = add_recipients(obj, read_recipients_csv(csv_file))
+            self.message_user(request, '{} recipients added'.format(added))
+            if invalid:
+                self.message_user(
+                        request, 'Skipped {} invalid phone numbers: {}'.format(
+                            len(invalid), ', '.join(invalid[:20])),
+                        level=messages.WARNING)
+
+    @admin.action(description='Start or resume sending')
+    def start_sending(self, request, queryset):
+        callback_site = twilio_callback_site(get_current_site(request))
+        for campaign in queryset.exclude(status=SmsCampaign.COMPLETED):
+            start_campaign(campaign, callback_site)
+
+    @admin.action(description='Pause sending')
+    def pause_sending(self, request, queryset):
+        for campaign in queryset:
+            pause_campaign(campaign)
+
+
+class SmsCampaignRecipientAdmin(admin.ModelAdmin):
+    list_display = ['campaign', 'phone', 'status', 'sid', 'last_activity',
+                    'error']
+    list_display_links = list_display
+    list_filter = ['campaign', 'status']
+    search_fields = ['phone', 'sid']
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 admin.site.register(Voice)
 admin.site.register(MailboxNumber, MailboxNumberAdmin)
 admin.site.register(Voicemail, VoicemailAdmin)
 admin.site.register(Menu, MenuAdmin)
 admin.site.register(MenuItem, MenuItemAdmin)
 admin.site.register(SmsMessage, SmsMessageAdmin)
+admin.site.register(Notification, NotificationAdmin)
 admin.site.register(TwilioNumber)
+admin.site.register(SmsCampaign, SmsCampaignAdmin)
+admin.site.register(SmsCampaignRecipient, SmsCampaignRecipientAdmin)
@@ -1,7 +1,6 @@
-from importlib import import_module
-
 from django.apps import AppConfig, apps
 from django.conf import settings
+from django.core.signals import request_started
 
 
 class TwilioCallCenterConfig(AppConfig):
@@ -9,12 +8,22 @@ class TwilioCallCenterConfig(AppConfig):
     verbose_name = 'Twilio Call Center'
 
     def ready(self):
+        # connect the cache invalidation signals and register the checks
+        from . import cache, checks
+        from .actions import LazyActionFunctions
+        from .schedule import check_scheduler_settings, scheduler_mode, \
+            start_on_request
+
+        check_scheduler_settings()
+        if scheduler_mode() == 'web':
+            request_started.connect(start_on_request,
+                                    dispatch_uid='twilio_call_center_scheduler')
+
         try:
             action_functions = settings.TWILIO_CALL_CENTER_ACTION_FUNCTIONS
         except:
             action_functions = []
-        self.action_functions = {m + '.' + f: getattr(import_module(m), f)
-                                 for m, f in action_functions}
+        self.action_functions = LazyActionFunctions(action_functions)
 
 def my_app():
     return apps.get_app_config(TwilioCallCenterConfig.name)
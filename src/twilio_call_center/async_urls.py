@@ -0,0 +1,27 @@
+''' The urls of the app with the async Twilio webhook views, use these in
+place of urls.py when the site is served with ASGI.'''
+from django.urls import path
+
+from . import async_views, views
+
+app_name = 'twilio_call_center'
+urlpatterns = [
+    path('send-sms', views.SendSmsView.as_view(), name='send-sms'),
+    path('send-sms-cb', async_views.send_sms_cb, name='send-sms-cb'),
+    path('sms-forward-cb', async_views.sms_forward_cb, name='sms-forward-cb'),
+    path('sms-incoming', async_views.sms_incoming, name='sms-incoming'),
+    path('sms-status', views.sms_status, name='sms-status'),
+    path('history/<slug:kind>', views.history_export, name='history-export'),
+    path('<slug:name>/call-menu', async_views.call_menu, name='call-menu'),
+    path('<slug:name>/call-action', async_views.call_action,
+         name='call-action'),
+    path('<slug:name>/call-pin/<slug:digit>', async_views.call_action,
+         name='call-pin'),
+    path('<slug:name>/call-poll/<slug:digit>', async_views.call_poll,
+         name='call-poll'),
+    path('<slug:name>/call-end', async_views.call_end, name='call-end'),
+    path('<slug:name>/voicemail/<slug:digit>', async_views.voicemail,
+         name='voicemail'),
+    path('<slug:name>/voicemail-sms-cb/<slug:digit>',
+         async_views.voicemail_sms_cb, name='voicemail-sms-cb'),
+]
@@ -0,0 +1,146 @@
+''' Async versions of the Twilio webhook views, for sites served with ASGI.
+
+Cached TwiML is returned without leaving the event loop. The database writes
+and the other blocking work run in threads with sync_to_async.
+'''
+import logging
+
+from asgiref.sync import sync_to_async
+from django.contrib.sites.shortcuts import get_current_site
+from django.http import Http404
+from twilio.twiml.messaging_response import MessagingResponse
+
+from .cache import afind_twilio_number, aget_compiled_menu, menu_cache
+from .models import Voicemail
+from .utils import async_twilio_view
+from .views import forward_incoming_sms, get_query_dict, \
+    handle_sms_cb_status, log_unknown_twilio_number, \
+    queue_voicemail_notification, render_call_action, render_call_end, \
+    render_call_menu, render_call_poll, render_invalid_entry, \
+    render_pin_prompt, render_voicemail_end, update_sms_message, \
+    voicemail_defaults
+
+
+logger = logging.getLogger(__name__)
+
+
+async def aget_menu(name):
+    menu = await aget_compiled_menu(name)
+    if menu is None:
+        raise Http404("Call Center menu {} doesn't exist.".format(name))
+    if len(menu.items) == 0:
+        raise Http404("Call Center menu {} has no items.".format(menu.name))
+    return menu
+
+
+async def acached_twiml(key, render):
+    return await menu_cache.aget(('twiml',) + key,
+                                 lambda: str(render()).encode())
+
+
+@async_twilio_view
+async def call_menu(request, name):
+    return await acached_twiml(('call-menu', name),
+                               lambda: render_call_menu(name))
+
+
+@async_twilio_view
+async def call_action(request, name, digit=None):
+    menu = await aget_menu(name)
+    pin = None
+
+    query_dict = get_query_dict(request)
+    if digit is None:
+        digit = query_dict['Digits']
+    else:
+        pin = query_dict['Digits']
+
+    item = menu.get_item(digit)
+    if item is None:
+        return await acached_twiml(
+                ('call-action', name, None),
+                lambda: render_call_action(request, name, None))
+
+    digit = item.menu_digit
+    if len(item.pin_digits_list):
+        if pin is None:
+            return await acached_twiml(('call-pin', name, digit),
+                                       lambda: render_pin_prompt(name, digit))
+        if pin not in item.pin_digits_list:
+            return await acached_twiml(('invalid-entry', name),
+                                       lambda: render_invalid_entry(name))
+
+    # mailbox availability and action functions change with each call
+    if item.action_mailbox or item.action_function:
+        return await sync_to_async(render_call_action)(request, name, digit)
+    return await acached_twiml(
+            ('call-action', name, digit),
+            lambda: render_call_action(request, name, digit))
+
+
+@async_twilio_view
+async def call_poll(request, name, digit):
+    return await sync_to_async(render_call_poll)(request, name, digit)
+
+
+@async_twilio_view
+async def call_end(request, name):
+    return await acached_twiml(('call-end', name),
+                               lambda: render_call_end(name))
+
+
+@async_twilio_view
+async def voicemail(request, name, digit):
+    query_dict = get_query_dict(request)
+    current_site = await sync_to_async(get_current_site)(request)
+    menu = await aget_menu(name)
+
+    await Voicemail.objects.aupdate_or_create(
+            sid=query_dict['RecordingSid'],
+            defaults=voicemail_defaults(query_dict, menu.get_item(digit)))
+    await sync_to_async(queue_voicemail_notification)(query_dict,
+                                                      current_site)
+
+    return await acached_twiml(('voicemail-end', name),
+                               lambda: render_voicemail_end(name))
+
+
+@async_twilio_view
+async def voicemail_sms_cb(request, name, digit):
+    cb_type = "Voicemail notification SMS for {} digit {}".format(
+            name, digit)
+    return handle_sms_cb_status(request, cb_type)
+
+
+@async_twilio_view
+async def sms_forward_cb(request):
+    return handle_sms_cb_status(request, "Forward SMS")
+
+
+@async_twilio_view
+async def sms_incoming(request):
+    query_dict = get_query_dict(request)
+    current_site = await sync_to_async(get_current_site)(request)
+    to_number = query_dict.get('To', None)
+    if to_number is None:
+        logger.error("Twilio API call has no 'To' field: " + str(query_dict))
+        return MessagingResponse()
+
+    await sync_to_async(update_sms_message)("Incoming SMS", query_dict)
+
+    twilio_phone = await afind_twilio_number(to_number)
+    if twilio_phone is None:
+        log_unknown_twilio_number(to_number)
+        return MessagingResponse()
+
+    await sync_to_async(forward_incoming_sms)(query_dict, current_site,
+                                              twilio_phone)
+    return MessagingResponse()
+
+
+@async_twilio_view
+async def send_sms_cb(request):
+    query_dict = get_query_dict(request)
+    await sync_to_async(update_sms_message)(
+            "SMS send callback", query_dict, status_only=True)
+    return handle_sms_cb_status(request, 'Sending SMS')
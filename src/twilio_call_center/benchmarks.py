@@ -0,0 +1,303 @@
+''' Latency benchmarks for the twilio webhooks.
+
+These are not found by the default test discovery, run them with
+
+    python manage.py test twilio_call_center.benchmarks
+
+Every endpoint is driven through the django test client against a generated
+menu tree, with the twilio API stubbed. The p50/p99 latency, queries and
+allocated memory per request are compared against benchmark_baseline.json.
+A benchmark fails when it makes more queries than the baseline, or when its
+p99 latency grows past the baseline times the tolerance plus the slack.
+
+StartupBenchmark times django.setup() and importing the urls in a fresh
+interpreter, and checks that no scheduler thread is started by either.
+
+Environment variables:
+    TWILIO_CALL_CENTER_BENCHMARK_DEPTH      submenu depth of the tree (3)
+    TWILIO_CALL_CENTER_BENCHMARK_WIDTH      items per menu, at most 9 (5)
+    TWILIO_CALL_CENTER_BENCHMARK_REQUESTS   requests per endpoint (200)
+    TWILIO_CALL_CENTER_BENCHMARK_TOLERANCE  allowed p99 growth factor (3.0)
+    TWILIO_CALL_CENTER_BENCHMARK_SLACK_MS   allowed p99 growth in ms (5)
+    TWILIO_CALL_CENTER_BENCHMARK_SAVE       set to 1 to save a new baseline
+'''
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from unittest import mock
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
+
+from .cache import menu_cache
+from .models import MailboxNumber, Menu, MenuItem, TwilioNumber
+from .schedule import scheduler
+
+
+urlpatterns = [
+    path('call-center/', include('twilio_call_center.urls')),
+]
+
+baseline_path = os.path.join(os.path.dirname(__file__),
+                             'benchmark_baseline.json')
+
+
+def env_setting(name, default, cast=int):
+    return cast(os.environ.get('TWILIO_CALL_CENTER_BENCHMARK_' + name,
+                               default))
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * len(values))))
+    return values[index]
+
+
+def build_menu_tree(depth, width, name='bench'):
+    ''' Creates a menu with width items, where the last item of each menu
+    leads to a submenu, depth menus deep. Digit 1 asks for a pin, digit 2
+    sends to voicemail. Returns the number of menus created.'''
+    mailbox = MailboxNumber.objects.create(name='bench-mailbox',
+                                           email_list='bench@example.com',
+                                           always_send_voicemail=True)
+    menus = [Menu.objects.create(name='{}-{}'.format(name, level),
+                                 greeting_text='Welcome to level {}'.format(
+                                     level))
+             for level in range(depth)]
+    items = []
+    for level, menu in enumerate(menus):
+        for digit in range(1, width + 1):
+            item = MenuItem(menu=menu, menu_digit=digit,
+                            menu_text='for option {}'.format(digit),
+                            action_text='You chose option {}'.format(digit))
+            if digit == 1:
+                item.pin_digits_list = '1234,5678'
+            elif digit == 2:
+                item.action_mailbox = mailbox
+            elif digit == width and level + 1 < depth:
+                item.action_submenu = menus[level + 1]
+            items.append(item)
+    MenuItem.objects.bulk_create(items)
+    menu_cache.invalidate()
+    return len(menus)
+
+
+class FakeMessage:
+    sid = 'SMbenchmark'
+    status = 'queued'
+    error_message = None
+
+
+@override_settings(ROOT_URLCONF=__name__,
+                   DJANGO_TWILIO_FORGERY_PROTECTION=False,
+                   DJANGO_TWILIO_BLACKLIST_CHECK=False)
+class WebhookBenchmark(TestCase):
+    results = {}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.depth = env_setting('DEPTH', 3)
+        cls.width = min(9, max(3, env_setting('WIDTH', 5)))
+        cls.requests = env_setting('REQUESTS', 200)
+        cls.tolerance = env_setting('TOLERANCE', 3.0, float)
+        cls.slack_ms = env_setting('SLACK_MS', 5.0, float)
+        build_menu_tree(cls.depth, cls.width)
+        TwilioNumber.objects.create(name='bench', phone='+17202010123',
+                                    forward_phone_list='+13035550100',
+                                    forward_email_list='bench@example.com')
+
+    def setUp(self):
+        twilio_client = mock.Mock()
+        twilio_client.messages.create.return_value = FakeMessage()
+        for module in ['views', 'notifications']:
+            patcher = mock.patch(
+                    'twilio_call_center.{}.twilio_client'.format(module),
+                    twilio_client)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # the test client must not start the real scheduler
+        self.addCleanup(lambda: self.assertFalse(scheduler.running))
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.report()
+
+    def measure(self, name, request):
+        ''' Runs request() repeatedly and records the statistics as name.'''
+        # warm up the caches, like a server that already took calls
+        self.assertLess(request(0).status_code, 300)
+
+        latencies = []
+        queries = []
+        for i in range(self.requests):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = request(i)
+                latencies.append(time.perf_counter() - start)
+            self.assertLess(response.status_code, 300)
+            queries.append(len(captured))
+
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            request(0)
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        allocated = sum(stat.size_diff for stat in
+                        after.compare_to(before, 'filename')
+                        if stat.size_diff > 0)
+
+        result = {
+            'p50_ms': round(statistics.median(latencies) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'queries': max(queries),
+            'allocated_kb': round(allocated / 1024, 1),
+        }
+        self.results[name] = result
+        self.check_baseline(name, result)
+
+    def check_baseline(self, name, result):
+        if os.environ.get('TWILIO_CALL_CENTER_BENCHMARK_SAVE') == '1':
+            return
+        try:
+            with open(baseline_path) as f:
+                baselines = json.load(f)
+        except OSError as e:
+            self.skipTest('No benchmark baseline to compare with: {}'
+                          .format(e))
+        if name not in baselines:
+            self.fail('{} has no baseline in {}, save one with '
+                      'TWILIO_CALL_CENTER_BENCHMARK_SAVE=1'
+                      .format(name, baseline_path))
+        baseline = baselines[name]
+        self.assertLessEqual(result['queries'], baseline['queries'],
+                             '{} makes more queries than the baseline'
+                             .format(name))
+        self.assertLessEqual(result['p99_ms'],
+                             baseline['p99_ms'] * self.tolerance +
+                             self.slack_ms,
+                             '{} p99 latency regressed'.format(name))
+
+    @classmethod
+    def report(cls):
+        if not cls.results:
+            return
+        lines = ['', 'Webhook benchmarks (depth {}, width {}, {} requests)'
+                 .format(cls.depth, cls.width, cls.requests),
+                 '{:<24}{:>10}{:>10}{:>9}{:>14}'.format(
+                     'endpoint', 'p50 ms', 'p99 ms', 'queries',
+                     'allocated kb')]
+        for name, result in sorted(cls.results.items()):
+            lines.append('{:<24}{:>10}{:>10}{:>9}{:>14}'.format(
+                name, result['p50_ms'], result['p99_ms'], result['queries'],
+                result['allocated_kb']))
+        sys.stderr.write('\n'.join(lines) + '\n')
+
+        if os.environ.get('TWILIO_CALL_CENTER_BENCHMARK_SAVE') == '1':
+            with open(baseline_path, 'w') as f:
+                json.dump(cls.results, f, indent=4, sort_keys=True)
+                f.write('\n')
+
+    def post(self, url, data=None):
+        return self.client.post('/call-center/' + url, data or {})
+
+    def last_menu(self):
+        return 'bench-{}'.format(self.depth - 1)
+
+    def test_call_menu(self):
+        self.measure('call_menu',
+                     lambda i: self.post(self.last_menu() + '/call-menu'))
+
+    def test_call_action(self):
+        digits = [str(d) for d in range(3, self.width + 1)]
+        self.measure('call_action', lambda i: self.post(
+            'bench-0/call-action', {'Digits': digits[i % len(digits)]}))
+
+    def test_call_action_pin_prompt(self):
+        self.measure('call_action_pin_prompt', lambda i: self.post(
+            'bench-0/call-action', {'Digits': '1'}))
+
+    def test_call_action_pin(self):
+        pins = ['1234', '5678', '0000']
+        self.measure('call_action_pin', lambda i: self.post(
+            'bench-0/call-pin/1', {'Digits': pins[i % len(pins)]}))
+
+    def test_voicemail(self):
+        self.measure('voicemail', lambda i: self.post(
+            'bench-0/voicemail/2', {
+                'RecordingSid': 'RE{}'.format(i),
+                'CallSid': 'CA{}'.format(i),
+                'From': '+13035550100',
+                'To': '+17202010123',
+                'RecordingUrl': 'https://example.com/RE{}'.format(i),
+                'CallStatus': 'completed',
+                'TranscriptionStatus': 'completed',
+                'TranscriptionText': 'Please call me back',
+            }))
+
+    def test_sms_incoming(self):
+        self.measure('sms_incoming', lambda i: self.post('sms-incoming', {
+            'MessageSid': 'SMin{}'.format(i),
+            'From': '+13035550100',
+            'To': '+17202010123',
+            'Body': 'Hello',
+            'SmsStatus': 'received',
+        }))
+
+    def test_send_sms_cb(self):
+        statuses = ['queued', 'sent', 'delivered']
+        self.measure('send_sms_cb', lambda i: self.post('send-sms-cb', {
+            'MessageSid': 'SMout{}'.format(i // len(statuses)),
+            'From': '+17202010123',
+            'To': '+13035550100',
+            'Body': 'Hello',
+            'SmsStatus': statuses[i % len(statuses)],
+            'MessageStatus': statuses[i % len(statuses)],
+        }))
+
+
+startup_script = """
+import json, threading, time
+start = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+import twilio_call_center.urls
+urls = time.perf_counter()
+print(json.dumps({
+    'setup_ms': round((setup - start) * 1000, 1),
+    'urls_ms': round((urls - setup) * 1000, 1),
+    'threads': threading.active_count(),
+}))
+"""
+
+
+class StartupBenchmark(SimpleTestCase):
+    runs = 5
+
+    def test_startup(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        results = []
+        for i in range(self.runs):
+            output = subprocess.run([sys.executable, '-c', startup_script],
+                                    env=env, check=True, capture_output=True,
+                                    text=True).stdout
+            results.append(json.loads(output.splitlines()[-1]))
+        # importing the app must not start the scheduler thread
+        self.assertEqual(max(r['threads'] for r in results), 1)
+        sys.stderr.write(
+                '\nStartup ({} runs): setup p50 {} ms, urls import p50 {} '
+                'ms, {} thread\n'.format(
+                    self.runs,
+                    statistics.median(r['setup_ms'] for r in results),
+                    statistics.median(r['urls_ms'] for r in results),
+                    results[0]['threads']))
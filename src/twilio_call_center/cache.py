@@ -0,0 +1,240 @@
+import threading
+import uuid
+
+from asgiref.sync import sync_to_async
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Menu, MenuItem, MailboxNumber, TwilioNumber, Voice, \
+    twilio_default_voice
+from .utils import normalize_phone_number
+
+
+def shared_cache():
+    alias = getattr(settings, 'TWILIO_CALL_CENTER_CACHE', 'default')
+    return caches[alias]
+
+
+_missing = object()
+
+
+class VersionedCache:
+    ''' Process local cache of values compiled from the database.
+
+    The current version is kept in the django cache, so every process that
+    shares the cache backend drops its compiled values when any process calls
+    invalidate().'''
+
+    def __init__(self, name):
+        self.name = name
+        self.version_key = 'twilio_call_center:{}:version'.format(name)
+        self._lock = threading.Lock()
+        self._version = None
+        self._values = {}
+
+    def current_version(self):
+        cache = shared_cache()
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, timeout=None)
+            version = cache.get(self.version_key)
+        return version
+
+    async def acurrent_version(self):
+        cache = shared_cache()
+        version = await cache.aget(self.version_key)
+        if version is None:
+            await cache.aadd(self.version_key, uuid.uuid4().hex, timeout=None)
+            version = await cache.aget(self.version_key)
+        return version
+
+    def get(self, key, build):
+        version = self.current_version()
+        value = self._lookup(version, key)
+        if value is _missing:
+            value = self._store(version, key, build())
+        return value
+
+    async def aget(self, key, build):
+        ''' Like get(), build is called in a thread when the value is not
+        cached.'''
+        version = await self.acurrent_version()
+        value = self._lookup(version, key)
+        if value is _missing:
+            value = self._store(version, key, await sync_to_async(build)())
+        return value
+
+    def _lookup(self, version, key):
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._values = {}
+            return self._values.get(key, _missing)
+
+    def _store(self, version, key, value):
+        # None is not stored, so requests for unknown keys like random menu
+        # names in urls don't grow the cache
+        if value is None:
+            return value
+        with self._lock:
+            # Don't store a value built while another process changed the
+            # database, it could already be stale
+            if version == self._version:
+                self._values[key] = value
+        return value
+
+    def invalidate(self):
+        shared_cache().set(self.version_key, uuid.uuid4().hex, timeout=None)
+        with self._lock:
+            self._version = None
+            self._values = {}
+
+
+menu_cache = VersionedCache('menus')
+twilio_number_cache = VersionedCache('twilio_numbers')
+
+
+class CompiledMailbox(namedtuple('CompiledMailbox', [
+        'id', 'name', 'phone', 'available_start', 'available_stop',
+        'always_send_voicemail'])):
+    __slots__ = ()
+    should_send_voicemail = MailboxNumber.should_send_voicemail
+    number_currently_unavailable = MailboxNumber.number_currently_unavailable
+
+
+class CompiledMenuItem(namedtuple('CompiledMenuItem', [
+        'id', 'menu_digit', 'menu_text', 'pin_digits_list', 'pin_text',
+        'action_text', 'action_mailbox', 'action_submenu', 'action_url',
+        'action_function'])):
+    ''' A MenuItem with the related objects resolved.
+
+    action_submenu is the name of the submenu, or None.'''
+    __slots__ = ()
+
+
+class CompiledMenu(namedtuple('CompiledMenu', [
+        'id', 'name', 'greeting_text', 'voice', 'items', 'items_by_digit'])):
+    ''' A Menu with its enabled items, ordered by digit.
+
+    voice is the twilio voice string, never None.'''
+    __slots__ = ()
+
+    def get_item(self, digit):
+        ''' Returns the first item for the digit, or None.'''
+        try:
+            digit = int(digit)
+        except (TypeError, ValueError):
+            return None
+        return self.items_by_digit.get(digit, None)
+
+
+def compile_mailbox(mailbox):
+    if mailbox is None:
+        return None
+    return CompiledMailbox(
+            id=mailbox.id,
+            name=mailbox.name,
+            phone=mailbox.phone,
+            available_start=mailbox.available_start,
+            available_stop=mailbox.available_stop,
+            always_send_voicemail=mailbox.always_send_voicemail)
+
+
+def compile_menu_item(item):
+    submenu = item.action_submenu
+    return CompiledMenuItem(
+            id=item.id,
+            menu_digit=item.menu_digit,
+            menu_text=item.menu_text,
+            pin_digits_list=tuple(item.get_pin_digits_list()),
+            pin_text=item.pin_text,
+            action_text=item.action_text,
+            action_mailbox=compile_mailbox(item.action_mailbox),
+            action_submenu=submenu.name if submenu else None,
+            action_url=item.action_url,
+            action_function=item.action_function)
+
+
+def compile_menu(name):
+    ''' Returns the CompiledMenu for an enabled menu name, or None.'''
+    menu = Menu.objects.filter(enabled=True, name=name) \
+        .select_related('voice').first()
+    if menu is None:
+        return None
+
+    query = MenuItem.objects.filter(enabled=True, menu=menu) \
+        .select_related('action_mailbox', 'action_submenu') \
+        .order_by('menu_digit', 'pk')
+    items = tuple(compile_menu_item(item) for item in query)
+    items_by_digit = {}
+    for item in items:
+        items_by_digit.setdefault(item.menu_digit, item)
+
+    return CompiledMenu(
+            id=menu.id,
+            name=menu.name,
+            greeting_text=menu.greeting_text,
+            voice=menu.voice.voice if menu.voice else twilio_default_voice,
+            items=items,
+            items_by_digit=MappingProxyType(items_by_digit))
+
+
+def get_compiled_menu(name):
+    return menu_cache.get(name, lambda: compile_menu(name))
+
+
+async def aget_compiled_menu(name):
+    return await menu_cache.aget(name, lambda: compile_menu(name))
+
+
+@receiver([post_save, post_delete], sender=Menu)
+@receiver([post_save, post_delete], sender=MenuItem)
+@receiver([post_save, post_delete], sender=MailboxNumber)
+@receiver([post_save, post_delete], sender=Voice)
+def invalidate_menu_cache(**kwargs):
+    menu_cache.invalidate()
+    # Invalidate again after the commit, otherwise another request could
+    # compile the old rows again before the new ones are visible
+    transaction.on_commit(menu_cache.invalidate)
+
+
+def build_twilio_number_index():
+    index = {}
+    for number in TwilioNumber.objects.all():
+        index[number.phone] = number
+        if number.phone_e164:
+            index.setdefault(number.phone_e164, number)
+    return index
+
+
+def find_twilio_number(phone):
+    ''' Returns the TwilioNumber matching the phone number string, or None.'''
+    return lookup_twilio_number(
+        twilio_number_cache.get('index', build_twilio_number_index), phone)
+
+
+async def afind_twilio_number(phone):
+    return lookup_twilio_number(
+        await twilio_number_cache.aget('index', build_twilio_number_index),
+        phone)
+
+
+def lookup_twilio_number(index, phone):
+    number = index.get(phone, None)
+    if number is None:
+        e164 = normalize_phone_number(phone)
+        if e164:
+            number = index.get(e164, None)
+    return number
+
+
+@receiver([post_save, post_delete], sender=TwilioNumber)
+def invalidate_twilio_number_cache(**kwargs):
+    twilio_number_cache.invalidate()
+    transaction.on_commit(twilio_number_cache.invalidate)
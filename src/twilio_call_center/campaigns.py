@@ -0,0 +1,202 @@
+import codecs
+import csv
+import logging
+
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.template import Context, Template
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import SmsCampaign, SmsCampaignRecipient
+from .schedule import renew_lease, run_exclusive, scheduler
+from .sms_upsert import upsert_sms_messages
+from .utils import RateLimiter, normalize_phone_number, twilio_client, \
+    twilio_fan_out
+
+
+logger = logging.getLogger(__name__)
+
+batch_size = 1000
+
+
+def campaign_rate():
+    ''' Messages per second sent from one twilio number.'''
+    return getattr(settings, 'TWILIO_CALL_CENTER_CAMPAIGN_RATE', 1)
+
+
+def read_recipients_csv(csv_file):
+    ''' Yields a dict for each row of the uploaded CSV file, which must have
+    a phone column. Raises ValueError when it does not.'''
+    reader = csv.DictReader(codecs.iterdecode(csv_file, 'utf-8-sig'))
+    fields = [field.strip().lower() for field in reader.fieldnames or []]
+    if 'phone' not in fields:
+        raise ValueError('The recipient list needs a phone column')
+    reader.fieldnames = fields
+    for row in reader:
+        yield {key: (value or '').strip() for key, value in row.items()
+               if key is not None}
+
+
+def add_recipients(campaign, rows):
+    ''' Adds a recipient for each dict of phone and template variables, like
+    the rows of read_recipients_csv() or a values() queryset.
+
+    Phones already in the campaign are skipped. Returns the number of rows
+    added and the list of phones which are not valid.'''
+    invalid = []
+    batch = []
+    before = campaign.recipients.count()
+
+    def save(batch):
+        SmsCampaignRecipient.objects.bulk_create(batch,
+                                                 ignore_conflicts=True)
+
+    for row in rows:
+        row = dict(row)
+        given = str(row.pop('phone', ''))
+        phone = normalize_phone_number(given)
+        if not phone:
+            invalid.append(given)
+            continue
+        batch.append(SmsCampaignRecipient(campaign=campaign, phone=phone,
+                                          context=row))
+        if len(batch) >= batch_size:
+            save(batch)
+            batch = []
+    if batch:
+        save(batch)
+    # bulk_create() does not tell which rows were skipped as duplicates
+    return campaign.recipients.count() - before, invalid
+
+
+def start_campaign(campaign, callback_site):
+    campaign.status = SmsCampaign.SENDING
+    campaign.callback_site = callback_site
+    campaign.last_activity = timezone.now()
+    campaign.save(update_fields=['status', 'callback_site', 'last_activity'])
+    transaction.on_commit(CampaignSender.dispatch_soon)
+
+
+def pause_campaign(campaign):
+    ''' Stops sending after the batch in progress.'''
+    SmsCampaign.objects.filter(pk=campaign.pk, status=SmsCampaign.SENDING) \
+        .update(status=SmsCampaign.PAUSED, last_activity=timezone.now())
+
+
+class CampaignSender:
+    ''' Sends the campaigns, one batch of recipients at a time.
+
+    Only one process sends from a twilio number at a time, so its rate
+    limit holds across workers. The recipients of each batch are marked
+    as sending before the messages go out, so a campaign resumes after the
+    last batch, and a message is never sent twice.'''
+    job_id = 'sms_campaigns'
+    soon_job_id = 'sms_campaigns_soon'
+    batch_size = 100
+    lease_duration = timedelta(minutes=10)
+
+    @classmethod
+    def begin(cls):
+        scheduler.add_job(cls().run, 'interval', replace_existing=True,
+                          minutes=1, id=cls.job_id)
+
+    @classmethod
+    def dispatch_soon(cls):
+        if not scheduler.running:
+            return
+        scheduler.add_job(cls().run, replace_existing=True, id=cls.soon_job_id)
+
+    def run(self):
+        sending = SmsCampaign.objects.filter(status=SmsCampaign.SENDING)
+        numbers = sending.values_list('twilio_number', flat=True).distinct()
+        for number in numbers:
+            run_exclusive(self.lease_name(number),
+                          lambda: self.send_from(number), self.lease_duration)
+
+    def lease_name(self, twilio_number_id):
+        return 'sms_campaign_number_{}'.format(twilio_number_id)
+
+    def batch_limit(self):
+        ''' The number of recipients sent under one lease renewal, sending
+        them at the campaign rate takes at most half of the lease.'''
+        rate = campaign_rate()
+        if not rate:
+            return self.batch_size
+        fits = int(rate * self.lease_duration.total_seconds() / 2)
+        return max(1, min(self.batch_size, fits))
+
+    def send_from(self, twilio_number_id):
+        rate_limiter = RateLimiter(campaign_rate())
+        campaigns = SmsCampaign.objects.filter(
+                status=SmsCampaign.SENDING,
+                twilio_number=twilio_number_id).order_by('created')
+        for campaign in campaigns.select_related('twilio_number'):
+            self.send_campaign(campaign, rate_limiter)
+
+    def send_campaign(self, campaign, rate_limiter):
+        recipients = campaign.recipients.order_by('id')
+        # a worker died while sending these, they may have been delivered
+        recipients.filter(status=SmsCampaignRecipient.SENDING).update(
+                status=SmsCampaignRecipient.FAILED,
+                error='Interrupted while sending',
+                last_activity=timezone.now())
+        template = Template(campaign.body)
+        status_callback = campaign.callback_site + \
+            reverse('twilio_call_center:send-sms-cb')
+
+        def send(recipient):
+            body = template.render(Context(recipient.context,
+                                           autoescape=False))
+            return twilio_client.messages.create(
+                    body=body, to=recipient.phone,
+                    from_=campaign.twilio_number.phone,
+                    status_callback=status_callback)
+
+        batch_limit = self.batch_limit()
+        while SmsCampaign.objects.filter(
+                pk=campaign.pk, status=SmsCampaign.SENDING).exists():
+            if not renew_lease(self.lease_name(campaign.twilio_number_id),
+                               self.lease_duration):
+                logger.error("Lost the lease for sending campaign {}".format(
+                    campaign))
+                return
+            batch = list(recipients.filter(
+                status=SmsCampaignRecipient.PENDING)[:batch_limit])
+            if len(batch) == 0:
+                SmsCampaign.objects.filter(
+                    pk=campaign.pk, status=SmsCampaign.SENDING) \
+                    .update(status=SmsCampaign.COMPLETED,
+                            last_activity=timezone.now())
+                return
+            recipients.filter(pk__in=[r.pk for r in batch]).update(
+                    status=SmsCampaignRecipient.SENDING,
+                    last_activity=timezone.now())
+            results = twilio_fan_out(send, batch, rate_limiter=rate_limiter)
+            self.record(campaign, batch, results)
+
+    def record(self, campaign, batch, results):
+        now = timezone.now()
+        messages = []
+        for recipient, (message, error) in zip(batch, results):
+            recipient.last_activity = now
+            if error is None:
+                recipient.status = SmsCampaignRecipient.SENT
+                recipient.sid = message.sid
+                messages.append(dict(
+                    sid=message.sid,
+                    from_phone=campaign.twilio_number.phone,
+                    to_phone=recipient.phone,
+                    message=getattr(message, 'body', None) or '',
+                    status=getattr(message, 'status', None) or 'unknown',
+                    last_activity=now))
+            else:
+                recipient.status = SmsCampaignRecipient.FAILED
+                recipient.error = str(error)
+                logger.error("Failed sending campaign {} to {}".format(
+                    campaign, recipient.phone))
+        SmsCampaignRecipient.objects.bulk_update(
+                batch, ['status', 'sid', 'error', 'last_activity'])
+        upsert_sms_messages(messages)
+        SmsCampaign.objects.filter(pk=campaign.pk).update(last_activity=now)
@@ -0,0 +1,15 @@
+from django.core import checks
+
+from .apps import my_app
+
+
+@checks.register(deploy=True)
+def check_action_functions(app_configs, **kwargs):
+    ''' Imports the action functions, which the calls only import when they
+    are first used.'''
+    errors = my_app().action_functions.check()
+    return [checks.Error(
+                'Action function {} cannot be used: {}'.format(name, error),
+                hint='Check TWILIO_CALL_CENTER_ACTION_FUNCTIONS.',
+                id='twilio_call_center.E001')
+            for name, error in sorted(errors.items())]
@@ -0,0 +1,131 @@
+''' Streams the SMS and voicemail history as CSV or newline delimited JSON.
+
+Rows are read in batches ordered by (last_activity, id), each batch starting
+after the last row of the one before, so memory use does not grow with the
+size of the history.
+'''
+import csv
+import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import SmsMessage, TwilioNumber, Voicemail
+
+
+history_kinds = {
+    'sms': (SmsMessage, ['id', 'sid', 'from_phone', 'to_phone', 'status',
+                         'last_activity', 'message']),
+    'voicemail': (Voicemail, ['id', 'sid', 'call_sid', 'mailbox_id',
+                              'mailbox__name', 'menu_item_id', 'from_phone',
+                              'to_phone', 'status', 'last_activity', 'url',
+                              'removed_from_twilio', 'transcription_status',
+                              'transcription']),
+}
+content_types = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+batch_size = 1000
+
+
+def twilio_number_filter(number):
+    ''' Returns a Q matching the messages sent to or from the TwilioNumber.'''
+    if not number.phone_e164:
+        return Q(to_phone=number.phone) | Q(from_phone=number.phone)
+    return Q(to_phone_e164=number.phone_e164) | \
+        Q(from_phone_e164=number.phone_e164)
+
+
+def parse_time(value):
+    ''' Parses an ISO date or datetime, in the current time zone when it
+    has none. Raises ValueError when it is not valid.'''
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('Invalid date: {}'.format(value))
+        parsed = datetime.datetime.combine(date, datetime.time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def history_queryset(kind, twilio_number=None, mailbox=None, start=None,
+                     end=None):
+    ''' Returns the rows of kind to export, from start up to but not
+    including end.
+
+    twilio_number and mailbox are ids. Raises ValueError for an unknown
+    kind, or a filter which does not apply to it.'''
+    try:
+        model, fields = history_kinds[kind]
+    except KeyError:
+        raise ValueError('Unknown history: {}'.format(kind))
+    queryset = model.objects.all()
+    if twilio_number is not None:
+        number = TwilioNumber.objects.filter(pk=twilio_number).first()
+        if number is None:
+            raise ValueError('Unknown twilio number: {}'.format(twilio_number))
+        queryset = queryset.filter(twilio_number_filter(number))
+    if mailbox is not None:
+        if model is not Voicemail:
+            raise ValueError('Only voicemail history has mailboxes')
+        queryset = queryset.filter(mailbox_id=mailbox)
+    if start is not None:
+        queryset = queryset.filter(last_activity__gte=start)
+    if end is not None:
+        queryset = queryset.filter(last_activity__lt=end)
+    return queryset.order_by('last_activity', 'id').values(*fields)
+
+
+def iter_history(queryset):
+    ''' Yields the rows of a history_queryset(), batch_size at a time.'''
+    last = None
+    while True:
+        batch = queryset
+        if last is not None:
+            batch = batch.filter(
+                    Q(last_activity__gt=last['last_activity']) |
+                    Q(last_activity=last['last_activity'], id__gt=last['id']))
+        batch = list(batch[:batch_size])
+        yield from batch
+        if len(batch) < batch_size:
+            break
+        last = batch[-1]
+
+
+class Echo:
+    ''' A file which returns what is written, for csv.writer.'''
+    def write(self, value):
+        return value
+
+
+def render_csv(kind, rows):
+    fields = history_kinds[kind][1]
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[field] for field in fields])
+
+
+def render_ndjson(kind, rows):
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(row) + '\n'
+
+
+renderers = {
+    'csv': render_csv,
+    'ndjson': render_ndjson,
+}
+
+
+def render_history(kind, output_format, queryset):
+    ''' Yields the history as chunks of text in output_format.'''
+    if output_format not in renderers:
+        raise ValueError('Unknown format: {}'.format(output_format))
+    return renderers[output_format](kind, iter_history(queryset))
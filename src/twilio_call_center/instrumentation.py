@@ -0,0 +1,217 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from contextlib import ExitStack
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('twilio_call_center_metrics', default=None)
+_totals_lock = threading.Lock()
+_totals = {}
+_action_totals = {}
+
+metric_help = [
+    ('requests_total', 'counter', 'Requests handled by the view.'),
+    ('request_seconds_sum', 'counter', 'Wall time spent in the view.'),
+    ('db_queries_total', 'counter', 'Database queries made by the view.'),
+    ('db_seconds_sum', 'counter', 'Time spent in database queries.'),
+    ('twilio_calls_total', 'counter', 'Twilio REST API calls.'),
+    ('twilio_seconds_sum', 'counter', 'Time spent in Twilio REST API calls.'),
+    ('twiml_bytes_sum', 'counter', 'Size of the returned responses.'),
+]
+
+action_metric_help = [
+    ('cache_hits_total', 'counter', 'Action results from the cache.'),
+    ('cache_misses_total', 'counter', 'Action calls to fill the cache.'),
+    ('timeouts_total', 'counter', 'Action calls which timed out.'),
+]
+
+
+def instrumentation_enabled():
+    return getattr(settings, 'TWILIO_CALL_CENTER_INSTRUMENTATION', False)
+
+
+class RequestMetrics:
+    def __init__(self, view):
+        self.view = view
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.twilio_calls = 0
+        self.twilio_seconds = 0.0
+
+    def db_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_queries += 1
+            self.db_seconds += time.perf_counter() - start
+
+
+def install_twilio_hook(client):
+    ''' Counts the REST calls made through client for the current request.'''
+    http_client = getattr(client, 'http_client', None)
+    if http_client is None or getattr(http_client, '_instrumented', False):
+        return
+    request = http_client.request
+
+    @wraps(request)
+    def instrumented_request(*args, **kwargs):
+        metrics = _current.get()
+        if metrics is None:
+            return request(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return request(*args, **kwargs)
+        finally:
+            metrics.twilio_calls += 1
+            metrics.twilio_seconds += time.perf_counter() - start
+
+    http_client.request = instrumented_request
+    http_client._instrumented = True
+
+
+def record(metrics, status, wall_seconds, twiml_bytes):
+    values = {
+        'requests_total': 1,
+        'request_seconds_sum': wall_seconds,
+        'db_queries_total': metrics.db_queries,
+        'db_seconds_sum': metrics.db_seconds,
+        'twilio_calls_total': metrics.twilio_calls,
+        'twilio_seconds_sum': metrics.twilio_seconds,
+        'twiml_bytes_sum': twiml_bytes,
+    }
+    with _totals_lock:
+        totals = _totals.setdefault(metrics.view, dict.fromkeys(values, 0))
+        for name, value in values.items():
+            totals[name] += value
+
+    logger.info(json.dumps({
+        'view': metrics.view,
+        'status': status,
+        'wall_ms': round(wall_seconds * 1000, 3),
+        'db_queries': metrics.db_queries,
+        'db_ms': round(metrics.db_seconds * 1000, 3),
+        'twilio_calls': metrics.twilio_calls,
+        'twilio_ms': round(metrics.twilio_seconds * 1000, 3),
+        'twiml_bytes': twiml_bytes,
+    }, sort_keys=True))
+
+
+def response_size(response):
+    if getattr(response, 'streaming', False):
+        return 0
+    return len(getattr(response, 'content', b''))
+
+
+def instrument_async_view(view, name=None):
+    ''' The database queries of an async view run in other threads, so only
+    its wall time, twilio calls and response size are recorded.'''
+    @wraps(view)
+    async def instrumented_view(request, *args, **kwargs):
+        if not instrumentation_enabled():
+            return await view(request, *args, **kwargs)
+
+        metrics = RequestMetrics(name or view.__name__)
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            response = await view(request, *args, **kwargs)
+        finally:
+            wall_seconds = time.perf_counter() - start
+            _current.reset(token)
+
+        record(metrics, getattr(response, 'status_code', None),
+               wall_seconds, response_size(response))
+        return response
+    return markcoroutinefunction(instrumented_view)
+
+
+def instrument_view(view, name=None):
+    ''' Records the wall time, database queries, twilio calls and response
+    size of each request when TWILIO_CALL_CENTER_INSTRUMENTATION is set.'''
+    if iscoroutinefunction(view):
+        return instrument_async_view(view, name)
+
+    @wraps(view)
+    def instrumented_view(request, *args, **kwargs):
+        if not instrumentation_enabled():
+            return view(request, *args, **kwargs)
+
+        metrics = RequestMetrics(name or view.__name__)
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                            connection.execute_wrapper(metrics.db_wrapper))
+                response = view(request, *args, **kwargs)
+        finally:
+            wall_seconds = time.perf_counter() - start
+            _current.reset(token)
+
+        record(metrics, getattr(response, 'status_code', None),
+               wall_seconds, response_size(response))
+        return response
+    return instrumented_view
+
+
+def count_action(function, name):
+    ''' Counts an action function cache hit, miss or timeout. These are
+    counted even without TWILIO_CALL_CENTER_INSTRUMENTATION.'''
+    with _totals_lock:
+        totals = _action_totals.setdefault(
+                function, dict.fromkeys([n for n, _, _ in action_metric_help],
+                                        0))
+        totals[name] += 1
+
+
+def get_metrics():
+    ''' Returns the totals recorded in this process, by view name.'''
+    with _totals_lock:
+        return {view: dict(totals) for view, totals in _totals.items()}
+
+
+def get_action_metrics():
+    ''' Returns the action function counters, by function name.'''
+    with _totals_lock:
+        return {function: dict(totals)
+                for function, totals in _action_totals.items()}
+
+
+def render_metrics():
+    ''' Returns the totals in the Prometheus text exposition format.'''
+    totals = get_metrics()
+    action_totals = get_action_metrics()
+    lines = []
+    for name, metric_type, help_text in metric_help:
+        full_name = 'twilio_call_center_' + name
+        lines.append('# HELP {} {}'.format(full_name, help_text))
+        lines.append('# TYPE {} {}'.format(full_name, metric_type))
+        for view in sorted(totals):
+            lines.append('{}{{view="{}"}} {}'.format(
+                full_name, view, totals[view][name]))
+    for name, metric_type, help_text in action_metric_help:
+        full_name = 'twilio_call_center_action_' + name
+        lines.append('# HELP {} {}'.format(full_name, help_text))
+        lines.append('# TYPE {} {}'.format(full_name, metric_type))
+        for function in sorted(action_totals):
+            lines.append('{}{{function="{}"}} {}'.format(
+                full_name, function, action_totals[function][name]))
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics():
+    with _totals_lock:
+        _totals.clear()
+        _action_totals.clear()
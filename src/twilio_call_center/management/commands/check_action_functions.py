@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from twilio_call_center.apps import my_app
+
+
+class Command(BaseCommand):
+    help = 'Imports every function of TWILIO_CALL_CENTER_ACTION_FUNCTIONS, ' \
+           'which are otherwise only imported when first used.'
+
+    def handle(self, *args, **options):
+        action_functions = my_app().action_functions
+        errors = action_functions.check()
+        for name in action_functions:
+            if name in errors:
+                self.stderr.write('{}: {}'.format(name, errors[name]))
+            else:
+                self.stdout.write('{}: ok'.format(name))
+        if errors:
+            raise CommandError('{} of {} action functions failed'.format(
+                len(errors), len(action_functions)))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from twilio_call_center.history import content_types, history_kinds, \
+    history_queryset, parse_time, render_history
+
+
+class Command(BaseCommand):
+    help = 'Writes the SMS or voicemail history ordered by last activity.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(history_kinds))
+        parser.add_argument('output', nargs='?', default='-',
+                            help='File to write, default is stdout.')
+        parser.add_argument('--format', default='csv',
+                            choices=sorted(content_types))
+        parser.add_argument('--twilio-number', type=int,
+                            help='Only messages to or from this TwilioNumber '
+                                 'id.')
+        parser.add_argument('--mailbox', type=int,
+                            help='Only voicemails for this MailboxNumber id.')
+        parser.add_argument('--start', type=parse_time,
+                            help='Only activity from this ISO date or time.')
+        parser.add_argument('--end', type=parse_time,
+                            help='Only activity before this ISO date or time.')
+
+    def handle(self, *args, **options):
+        try:
+            queryset = history_queryset(
+                    options['kind'], twilio_number=options['twilio_number'],
+                    mailbox=options['mailbox'], start=options['start'],
+                    end=options['end'])
+            chunks = render_history(options['kind'], options['format'],
+                                    queryset)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['output'] == '-':
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+        else:
+            with open(options['output'], 'w', encoding='utf-8',
+                      newline='') as f:
+                f.writelines(chunks)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from twilio_call_center.menu_io import export_menus
+
+
+class Command(BaseCommand):
+    help = 'Writes the menus, menu items, mailbox numbers, voices and ' \
+           'twilio numbers as newline delimited JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', nargs='?', default='-',
+                            help='File to write, default is stdout.')
+
+    def handle(self, *args, **options):
+        if options['output'] == '-':
+            count = export_menus(self.stdout)
+        else:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                count = export_menus(f)
+        self.stderr.write('Exported {} rows'.format(count))
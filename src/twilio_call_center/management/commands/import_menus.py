@@ -0,0 +1,27 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from twilio_call_center.menu_io import import_menus
+
+
+class Command(BaseCommand):
+    help = 'Creates or updates the rows written by export_menus, in one ' \
+           'transaction. Existing rows are matched by id.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='File to read, or - for stdin.')
+
+    def handle(self, *args, **options):
+        try:
+            if options['input'] == '-':
+                counts = import_menus(sys.stdin)
+            else:
+                with open(options['input'], encoding='utf-8') as f:
+                    counts = import_menus(f)
+        except (IntegrityError, OSError, ValueError) as e:
+            raise CommandError(str(e))
+        for name, (created, updated) in counts.items():
+            self.stdout.write('{}: {} created, {} updated'.format(
+                name, created, updated))
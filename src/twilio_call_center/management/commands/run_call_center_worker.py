@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from twilio_call_center.schedule import scheduler, start_scheduler
+
+
+class Command(BaseCommand):
+    help = 'Runs the call center background jobs until interrupted. Use ' \
+           'with TWILIO_CALL_CENTER_SCHEDULER = "worker", so the web ' \
+           'processes do not run them too.'
+
+    def handle(self, *args, **options):
+        start_scheduler()
+        self.stdout.write('Call center worker started')
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            scheduler.shutdown()
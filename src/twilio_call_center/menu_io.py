@@ -0,0 +1,143 @@
+''' Streams the menu tree to and from newline delimited JSON.
+
+Each line is one object, {"model": "menu", "id": 3, "fields": {...}}.
+Foreign keys are written as ids, and the ids are kept on import, so a dump
+can be loaded back into the same or an empty database.
+'''
+import json
+
+from itertools import groupby
+
+from django.core.management.color import no_style
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router, transaction
+
+from .cache import menu_cache, twilio_number_cache
+from .models import MailboxNumber, Menu, MenuItem, NormalizedPhoneField, \
+    TwilioNumber, Voice
+from .utils import normalize_phone_number
+
+
+# in dependency order, a model only refers to the models before it
+menu_models = [Voice, TwilioNumber, MailboxNumber, Menu, MenuItem]
+models_by_name = {model._meta.model_name: model for model in menu_models}
+
+batch_size = 1000
+
+
+def data_fields(model):
+    return [field for field in model._meta.concrete_fields
+            if not field.primary_key and
+            not isinstance(field, NormalizedPhoneField)]
+
+
+def normalized_fields(model):
+    return [field for field in model._meta.concrete_fields
+            if isinstance(field, NormalizedPhoneField)]
+
+
+def export_menus(stream):
+    ''' Writes every menu model to stream, one row per line.
+
+    Returns the number of rows written.'''
+    encoder = DjangoJSONEncoder()
+    count = 0
+    for model in menu_models:
+        fields = data_fields(model)
+        names = [field.attname for field in fields]
+        rows = model.objects.order_by('pk').values_list('pk', *names)
+        for row in rows.iterator(chunk_size=batch_size):
+            stream.write(encoder.encode({
+                'model': model._meta.model_name,
+                'id': row[0],
+                'fields': {field.name: value
+                           for field, value in zip(fields, row[1:])},
+            }) + '\n')
+            count += 1
+    return count
+
+
+def read_rows(stream):
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            model = models_by_name[row['model']]
+            yield model, row['id'], row['fields']
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError('Invalid row on line {}: {}'.format(
+                line_number, e))
+
+
+def build_object(model, pk, values):
+    obj = model(pk=pk)
+    for field in data_fields(model):
+        if field.name in values:
+            setattr(obj, field.attname, field.to_python(values[field.name]))
+    return obj
+
+
+def save_batch(model, objects, using):
+    ''' Creates the new objects and updates the existing ones, keeping the
+    last one given for each id.'''
+    objects = list({obj.pk: obj for obj in objects}.values())
+    existing = set(model.objects.using(using)
+                   .filter(pk__in=[obj.pk for obj in objects])
+                   .values_list('pk', flat=True))
+    created = [obj for obj in objects if obj.pk not in existing]
+    updated = [obj for obj in objects if obj.pk in existing]
+
+    model.objects.using(using).bulk_create(created)
+    if updated:
+        # bulk_update does not call pre_save, set the normalized phones here
+        normalized = normalized_fields(model)
+        for obj in updated:
+            for field in normalized:
+                setattr(obj, field.attname, normalize_phone_number(
+                    getattr(obj, field.source)))
+        model.objects.using(using).bulk_update(
+                updated, [field.name for field in data_fields(model)] +
+                [field.name for field in normalized])
+    return len(created), len(updated)
+
+
+def import_menus(stream):
+    ''' Creates or updates the rows written by export_menus() in one
+    transaction, batch_size rows at a time.
+
+    Returns {model name: (created, updated)}.'''
+    using = router.db_for_write(Menu)
+    counts = {model._meta.model_name: [0, 0] for model in menu_models}
+
+    def save(model, batch):
+        created, updated = save_batch(model, batch, using)
+        counts[model._meta.model_name][0] += created
+        counts[model._meta.model_name][1] += updated
+
+    with transaction.atomic(using=using):
+        for model, group in groupby(read_rows(stream), key=lambda row: row[0]):
+            batch = []
+            for _, pk, values in group:
+                batch.append(build_object(model, pk, values))
+                if len(batch) >= batch_size:
+                    save(model, batch)
+                    batch = []
+            if batch:
+                save(model, batch)
+
+        # rows were inserted with their ids, move the sequences past them
+        connection = connections[using]
+        sequence_sql = connection.ops.sequence_reset_sql(no_style(),
+                                                         menu_models)
+        if sequence_sql:
+            with connection.cursor() as cursor:
+                for sql in sequence_sql:
+                    cursor.execute(sql)
+
+        # bulk operations do not send the signals which clear the caches
+        transaction.on_commit(menu_cache.invalidate, using=using)
+        transaction.on_commit(twilio_number_cache.invalidate, using=using)
+    menu_cache.invalidate()
+    twilio_number_cache.invalidate()
+    return {name: tuple(count) for name, count in counts.items()}
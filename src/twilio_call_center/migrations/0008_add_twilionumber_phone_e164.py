@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:38
+
+import twilio_call_center.models
+from django.db import migrations
+
+from twilio_call_center.utils import normalize_phone_number
+
+
+def fill_phone_e164(apps, schema_editor):
+    TwilioNumber = apps.get_model('twilio_call_center', 'TwilioNumber')
+    numbers = list(TwilioNumber.objects.all())
+    for number in numbers:
+        number.phone_e164 = normalize_phone_number(number.phone)
+    TwilioNumber.objects.bulk_update(numbers, ['phone_e164'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twilio_call_center', '0007_add_voicemail_removal_field'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='twilionumber',
+            name='phone_e164',
+            field=twilio_call_center.models.NormalizedPhoneField(blank=True, db_index=True, editable=False, max_length=20, source='phone'),
+        ),
+        migrations.RunPython(fill_phone_e164, migrations.RunPython.noop),
+    ]
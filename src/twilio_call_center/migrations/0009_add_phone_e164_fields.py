@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:38
+
+import twilio_call_center.models
+from django.db import migrations
+
+from twilio_call_center.utils import normalize_phone_number
+
+
+batch_size = 1000
+phone_fields = {
+    'mailboxnumber': ['phone'],
+    'smsmessage': ['from_phone', 'to_phone'],
+    'voicemail': ['from_phone', 'to_phone'],
+}
+
+
+def fill_phone_e164(apps, schema_editor):
+    for model_name, sources in phone_fields.items():
+        model = apps.get_model('twilio_call_center', model_name)
+        fields = [source + '_e164' for source in sources]
+        last_pk = 0
+        while True:
+            # walk the primary key instead of one large query, the message
+            # tables can hold millions of rows
+            batch = list(model.objects.filter(pk__gt=last_pk)
+                         .order_by('pk').only('pk', *sources)[:batch_size])
+            if len(batch) == 0:
+                break
+            for obj in batch:
+                for source, field in zip(sources, fields):
+                    setattr(obj, field,
+                            normalize_phone_number(getattr(obj, source)))
+            model.objects.bulk_update(batch, fields)
+            last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twilio_call_center', '0008_add_twilionumber_phone_e164'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailboxnumber',
+            name='phone_e164',
+            field=twilio_call_center.models.NormalizedPhoneField(blank=True, db_index=True, editable=False, max_length=20, source='phone'),
+        ),
+        migrations.AddField(
+            model_name='smsmessage',
+            name='from_phone_e164',
+            field=twilio_call_center.models.NormalizedPhoneField(blank=True, db_index=True, editable=False, max_length=20, source='from_phone'),
+        ),
+        migrations.AddField(
+            model_name='smsmessage',
+            name='to_phone_e164',
+            field=twilio_call_center.models.NormalizedPhoneField(blank=True, db_index=True, editable=False, max_length=20, source='to_phone'),
+        ),
+        migrations.AddField(
+            model_name='voicemail',
+            name='from_phone_e164',
+            field=twilio_call_center.models.NormalizedPhoneField(blank=True, db_index=True, editable=False, max_length=20, source='from_phone'),
+        ),
+        migrations.AddField(
+            model_name='voicemail',
+            name='to_phone_e164',
+            field=twilio_call_center.models.NormalizedPhoneField(blank=True, db_index=True, editable=False, max_length=20, source='to_phone'),
+        ),
+        migrations.RunPython(fill_phone_e164, migrations.RunPython.noop),
+    ]
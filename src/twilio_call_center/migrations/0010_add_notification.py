@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:43
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twilio_call_center', '0009_add_phone_e164_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('email', 'Email'), ('sms', 'SMS'), ('voicemail', 'Voicemail notifications')], max_length=16)),
+                ('key', models.CharField(blank=True, db_index=True, help_text='Optional key used to cancel a pending notification.', max_length=64)),
+                ('payload', models.JSONField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed'), ('canceled', 'Canceled')], default='pending', max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt'], name='twilio_call_status_a742c1_idx')],
+            },
+        ),
+    ]
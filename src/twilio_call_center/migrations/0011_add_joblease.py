@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twilio_call_center', '0010_add_notification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('owner', models.CharField(blank=True, max_length=128)),
+                ('expires', models.DateTimeField(blank=True, null=True)),
+                ('last_run', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twilio_call_center', '0011_add_joblease'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='menuitem',
+            index=models.Index(fields=['menu', 'enabled', 'menu_digit'], name='tcc_menuitem_menu_digit_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='smsmessage',
+            index=models.Index(fields=['last_activity', 'id'], name='tcc_smsmessage_activity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='voicemail',
+            index=models.Index(fields=['last_activity', 'id'], name='tcc_voicemail_activity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='voicemail',
+            index=models.Index(condition=models.Q(('removed_from_twilio', False)), fields=['last_activity', 'id'], name='tcc_voicemail_unremoved_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:57
+
+import django.db.models.deletion
+import django.utils.timezone
+import twilio_call_center.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twilio_call_center', '0012_add_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SmsCampaign',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=80)),
+                ('body', models.TextField(help_text='The message to send. Columns of the recipient list can be used as template variables, ex: Hello {{ name }}.', max_length=1600)),
+                ('status', models.CharField(choices=[('draft', 'Draft'), ('sending', 'Sending'), ('paused', 'Paused'), ('completed', 'Completed')], default='draft', max_length=16)),
+                ('callback_site', models.CharField(blank=True, editable=False, help_text='The site url used for the status callbacks.', max_length=200)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+                ('twilio_number', models.ForeignKey(help_text='The phone number the messages are sent from.', on_delete=django.db.models.deletion.PROTECT, to='twilio_call_center.twilionumber')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SmsCampaignRecipient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phone', twilio_call_center.models.PhoneField(max_length=20)),
+                ('context', models.JSONField(blank=True, default=dict, help_text='The template variables for this recipient.')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('sid', models.CharField(blank=True, max_length=40)),
+                ('error', models.TextField(blank=True)),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='twilio_call_center.smscampaign')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['campaign', 'status', 'id'], name='tcc_campaign_recipient_idx')],
+                'constraints': [models.UniqueConstraint(fields=('campaign', 'phone'), name='tcc_campaign_recipient_phone')],
+            },
+        ),
+    ]
@@ -5,7 +5,7 @@ from django.core.validators import MaxValueValidator, MinValueValidator, \
 from django.forms.widgets import Input
 from django.utils import timezone
 
-from .utils import split_list_or_empty
+from .utils import split_list_or_empty, normalize_phone_number
 from .validators import validate_phone_number, validate_email_list, \
         validate_phone_list, validate_pin_digits_list
 
@@ -31,6 +31,27 @@ class PhoneField(models.CharField):
         return super().formfield(**defaults)
 
 
+class NormalizedPhoneField(models.CharField):
+    ''' Stores the E.164 form of the source PhoneField, so phone numbers can
+    be matched in the database instead of parsing every row.'''
+    def __init__(self, source=None, **kwargs):
+        self.source = source
+        defaults = dict(max_length=20, blank=True, editable=False,
+                        db_index=True)
+        defaults.update(kwargs)
+        super().__init__(**defaults)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = normalize_phone_number(getattr(model_instance, self.source))
+        setattr(model_instance, self.attname, value)
+        return value
+
+
 class Voice(models.Model):
     voice = models.CharField(
             help_text='Twilio voice (ex: man, woman).',
@@ -61,6 +82,7 @@ class Menu(models.Model):
 class TwilioNumber(models.Model):
     name = models.CharField(max_length=40, unique=True)
     phone = PhoneField(unique=True)
+    phone_e164 = NormalizedPhoneField('phone')
     forward_phone_list = models.TextField(
             help_text='A comma separated list of phone numbers which receive ' +
                 'sms forward notifications.',
@@ -88,6 +110,7 @@ class MailboxNumber(models.Model):
             help_text='Phone number to connect to. If left blank, always ' +
                 'send to voicemail.',
             blank=True)
+    phone_e164 = NormalizedPhoneField('phone')
     notification_phone = models.ForeignKey(TwilioNumber, on_delete=models.SET_NULL,
             help_text='Use this phone number to send the sms notifications.',
             blank=True, null=True)
@@ -192,6 +215,13 @@ class MenuItem(models.Model):
                 'the result.',
             max_length=100, blank=True)
 
+    class Meta:
+        indexes = [
+            # the enabled items of a menu, in digit order
+            models.Index(fields=['menu', 'enabled', 'menu_digit'],
+                         name='tcc_menuitem_menu_digit_idx'),
+        ]
+
     def get_pin_digits_list(self):
         return split_list_or_empty(self.pin_digits_list)
 
@@ -212,6 +242,8 @@ class Voicemail(models.Model):
             blank=True, null=True)
     from_phone = PhoneField()
     to_phone = PhoneField()
+    from_phone_e164 = NormalizedPhoneField('from_phone')
+    to_phone_e164 = NormalizedPhoneField('to_phone')
     transcription = models.TextField(
             help_text='A transcription of the recorded message',
             blank=True)
@@ -224,6 +256,17 @@ class Voicemail(models.Model):
             max_length=32, blank=True)
     last_activity = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            # history export and retention
+            models.Index(fields=['last_activity', 'id'],
+                         name='tcc_voicemail_activity_idx'),
+            # recordings still to delete from twilio
+            models.Index(fields=['last_activity', 'id'],
+                         condition=models.Q(removed_from_twilio=False),
+                         name='tcc_voicemail_unremoved_idx'),
+        ]
+
     def __str__(self):
         return self.sid
 
@@ -232,9 +275,145 @@ class SmsMessage(models.Model):
     sid = models.CharField(max_length=40, unique=True)
     from_phone = PhoneField()
     to_phone = PhoneField()
+    from_phone_e164 = NormalizedPhoneField('from_phone')
+    to_phone_e164 = NormalizedPhoneField('to_phone')
     message = models.TextField()
     status = models.CharField(max_length=32)
     last_activity = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_activity', 'id'],
+                         name='tcc_smsmessage_activity_idx'),
+        ]
+
     def __str__(self):
         return self.sid
+
+
+class Notification(models.Model):
+    ''' An outgoing email or SMS, delivered by the notification dispatcher.'''
+    EMAIL = 'email'
+    SMS = 'sms'
+    VOICEMAIL = 'voicemail'
+    kind_choices = [
+        (EMAIL, 'Email'),
+        (SMS, 'SMS'),
+        (VOICEMAIL, 'Voicemail notifications'),
+    ]
+
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    CANCELED = 'canceled'
+    status_choices = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+        (CANCELED, 'Canceled'),
+    ]
+
+    kind = models.CharField(max_length=16, choices=kind_choices)
+    key = models.CharField(
+            help_text='Optional key used to cancel a pending notification.',
+            max_length=64, blank=True, db_index=True)
+    payload = models.JSONField()
+    status = models.CharField(max_length=16, choices=status_choices,
+                              default=PENDING)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(default=timezone.now)
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt']),
+        ]
+
+    def __str__(self):
+        return "{}-{}".format(self.kind, self.pk)
+
+
+class JobLease(models.Model):
+    ''' Lets one process at a time run a periodic job, when several worker
+    processes run the scheduler.'''
+    name = models.CharField(max_length=64, unique=True)
+    owner = models.CharField(max_length=128, blank=True)
+    expires = models.DateTimeField(null=True, blank=True)
+    last_run = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class SmsCampaign(models.Model):
+    ''' One SMS message body sent to a list of recipients.'''
+    DRAFT = 'draft'
+    SENDING = 'sending'
+    PAUSED = 'paused'
+    COMPLETED = 'completed'
+    status_choices = [
+        (DRAFT, 'Draft'),
+        (SENDING, 'Sending'),
+        (PAUSED, 'Paused'),
+        (COMPLETED, 'Completed'),
+    ]
+
+    name = models.CharField(max_length=80)
+    twilio_number = models.ForeignKey(TwilioNumber, on_delete=models.PROTECT,
+            help_text='The phone number the messages are sent from.')
+    body = models.TextField(
+            help_text='The message to send. Columns of the recipient list ' +
+                'can be used as template variables, ex: Hello {{ name }}.',
+            max_length=1600)
+    status = models.CharField(max_length=16, choices=status_choices,
+                              default=DRAFT)
+    callback_site = models.CharField(
+            help_text='The site url used for the status callbacks.',
+            max_length=200, blank=True, editable=False)
+    created = models.DateTimeField(default=timezone.now)
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.name
+
+
+class SmsCampaignRecipient(models.Model):
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    status_choices = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    campaign = models.ForeignKey(SmsCampaign, on_delete=models.CASCADE,
+                                 related_name='recipients')
+    phone = PhoneField()
+    context = models.JSONField(
+            help_text='The template variables for this recipient.',
+            default=dict, blank=True)
+    status = models.CharField(max_length=16, choices=status_choices,
+                              default=PENDING)
+    sid = models.CharField(max_length=40, blank=True)
+    error = models.TextField(blank=True)
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['campaign', 'phone'],
+                                    name='tcc_campaign_recipient_phone'),
+        ]
+        indexes = [
+            models.Index(fields=['campaign', 'status', 'id'],
+                         name='tcc_campaign_recipient_idx'),
+        ]
+
+    def __str__(self):
+        return "{}-{}".format(self.campaign, self.phone)
@@ -0,0 +1,168 @@
+import logging
+
+from datetime import timedelta
+from django.core.mail import send_mail
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Notification, Voicemail
+from .schedule import scheduler
+from .utils import twilio_client, twilio_fan_out
+
+
+logger = logging.getLogger(__name__)
+
+
+def send_email_notification(payload):
+    send_mail(payload['subject'], payload['message'], payload['from_email'],
+              payload['recipient_list'],
+              html_message=payload.get('html_message', None))
+
+
+def send_sms_notification(payload):
+    twilio_client.messages.create(**payload)
+
+
+def send_voicemail_notification(payload):
+    from .views import send_voicemail_notifications
+
+    voicemail = Voicemail.objects.get(sid=payload['sid'])
+    send_voicemail_notifications(voicemail, payload['site'])
+
+
+handlers = {
+    Notification.EMAIL: send_email_notification,
+    Notification.SMS: send_sms_notification,
+    Notification.VOICEMAIL: send_voicemail_notification,
+}
+
+
+def enqueue_notification(kind, payload, delay=None, key=''):
+    ''' Stores a notification for the dispatcher to deliver.
+
+    Without a delay, the dispatcher is woken up once the transaction
+    commits.'''
+    now = timezone.now()
+    notification = Notification.objects.create(
+            kind=kind, key=key, payload=payload,
+            next_attempt=now if delay is None else now + delay)
+    if delay is None:
+        transaction.on_commit(NotificationDispatcher.dispatch_soon)
+    return notification
+
+
+def enqueue_email(subject, message, from_email, recipient_list,
+                  html_message=None):
+    return enqueue_notification(Notification.EMAIL, dict(
+        subject=subject,
+        message=message,
+        from_email=from_email,
+        recipient_list=recipient_list,
+        html_message=html_message))
+
+
+def enqueue_sms(**kwargs):
+    ''' Takes the keyword arguments of twilio_client.messages.create().'''
+    return enqueue_notification(Notification.SMS, kwargs)
+
+
+def cancel_notifications(key):
+    return Notification.objects.filter(key=key, status=Notification.PENDING) \
+        .update(status=Notification.CANCELED, last_activity=timezone.now())
+
+
+class NotificationDispatcher:
+    job_id = 'notification_dispatch'
+    soon_job_id = 'notification_dispatch_soon'
+    batch_size = 50
+    concurrent_kinds = {Notification.SMS}
+    max_attempts = 5
+    retry_delay = timedelta(minutes=1)
+    # a notification still sending after this long was lost by a dead worker
+    sending_timeout = timedelta(minutes=10)
+
+    @classmethod
+    def begin(cls):
+        scheduler.add_job(cls().run, 'interval', replace_existing=True,
+                          minutes=1, id=cls.job_id)
+
+    @classmethod
+    def dispatch_soon(cls):
+        # without a scheduler in this process, the worker picks the
+        # notification up on its next run
+        if not scheduler.running:
+            return
+        scheduler.add_job(cls().run, replace_existing=True, id=cls.soon_job_id)
+
+    def claim(self):
+        ''' Returns a batch of ready notifications, marked as sending.
+
+        Each row is claimed with a conditional update, so several workers
+        never deliver the same notification.'''
+        now = timezone.now()
+        ready = Notification.objects.filter(
+            status=Notification.PENDING, next_attempt__lte=now) | \
+            Notification.objects.filter(
+                status=Notification.SENDING,
+                last_activity__lt=now - self.sending_timeout)
+        claimed = []
+        for notification in ready.order_by('next_attempt')[:self.batch_size]:
+            updated = Notification.objects.filter(
+                pk=notification.pk, status=notification.status,
+                last_activity=notification.last_activity) \
+                .update(status=Notification.SENDING, last_activity=now)
+            if updated:
+                notification.status = Notification.SENDING
+                notification.last_activity = now
+                claimed.append(notification)
+        return claimed
+
+    def record(self, notification, error):
+        notification.attempts += 1
+        if error is None:
+            notification.status = Notification.SENT
+            notification.last_error = ''
+        else:
+            notification.last_error = str(error)
+            if notification.attempts >= self.max_attempts:
+                notification.status = Notification.FAILED
+                logger.error("Failed sending notification {}".format(
+                    notification))
+                logger.error(str(error))
+            else:
+                notification.status = Notification.PENDING
+                notification.next_attempt = timezone.now() + \
+                    self.retry_delay * 2 ** (notification.attempts - 1)
+        notification.last_activity = timezone.now()
+        notification.save(update_fields=['status', 'attempts', 'last_error',
+                                         'next_attempt', 'last_activity'])
+
+    def deliver(self, notification):
+        try:
+            handlers[notification.kind](notification.payload)
+            error = None
+        except Exception as e:
+            error = e
+        self.record(notification, error)
+
+    def deliver_batch(self, batch):
+        # SMS only wait on the twilio API, so send them concurrently. The
+        # other kinds use the database and stay on this thread.
+        concurrent = [n for n in batch if n.kind in self.concurrent_kinds]
+        results = twilio_fan_out(
+                lambda notification: handlers[notification.kind](
+                    notification.payload),
+                concurrent)
+        for notification, (_, error) in zip(concurrent, results):
+            self.record(notification, error)
+
+        for notification in batch:
+            if notification.kind not in self.concurrent_kinds:
+                self.deliver(notification)
+
+    def run(self):
+        while True:
+            batch = self.claim()
+            if len(batch) == 0:
+                break
+            self.deliver_batch(batch)
@@ -0,0 +1,121 @@
+import gzip
+import logging
+import os
+
+from datetime import timedelta
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+
+from .history import history_kinds, render_ndjson
+from .schedule import renew_lease, run_exclusive, scheduler
+
+
+logger = logging.getLogger(__name__)
+
+
+def retention_days():
+    ''' Returns {history kind: days to keep}, for the kinds with a retention
+    setting.'''
+    days = {
+        'sms': getattr(settings, 'TWILIO_CALL_CENTER_SMS_RETENTION', None),
+        'voicemail': getattr(
+            settings, 'TWILIO_CALL_CENTER_VOICEMAIL_RETENTION', None),
+    }
+    return {kind: value for kind, value in days.items() if value is not None}
+
+
+class RetentionSweeper:
+    ''' Moves the SMS messages and voicemails older than their retention
+    into gzipped newline delimited JSON files, then deletes them.'''
+    job_id = 'retention_sweep'
+    batch_size = 1000
+    check_interval = timedelta(hours=1)
+    run_interval = timedelta(days=1)
+    lease_duration = timedelta(minutes=30)
+
+    def __init__(self, days, archive_dir):
+        self.days = days
+        self.archive_dir = archive_dir
+
+    @classmethod
+    def from_settings(cls):
+        days = retention_days()
+        if len(days) == 0:
+            return None
+        for kind, value in days.items():
+            if value <= 0:
+                raise ImproperlyConfigured(
+                        "TWILIO_CALL_CENTER_{}_RETENTION must be integer "
+                        "greater than 0".format(kind.upper()))
+        archive_dir = getattr(settings, 'TWILIO_CALL_CENTER_ARCHIVE_DIR',
+                              None)
+        if not archive_dir:
+            raise ImproperlyConfigured(
+                    "TWILIO_CALL_CENTER_ARCHIVE_DIR is required with a "
+                    "retention setting")
+        return cls(days, archive_dir)
+
+    @classmethod
+    def begin(cls):
+        sweeper = cls.from_settings()
+        if sweeper is None:
+            return
+        scheduler.add_job(sweeper.check, 'interval', replace_existing=True,
+                          seconds=cls.check_interval.total_seconds(),
+                          id=cls.job_id)
+
+    def check(self):
+        return run_exclusive(self.job_id, self.run, self.lease_duration,
+                             every=self.run_interval)
+
+    def expired(self, kind, now):
+        model, fields = history_kinds[kind]
+        queryset = model.objects.filter(
+                last_activity__lt=now - timedelta(days=self.days[kind]))
+        if kind == 'voicemail' and getattr(
+                settings, 'TWILIO_CALL_CENTER_VOICEMAIL_LIFESPAN', None):
+            # keep the row until VoicemailChecker deleted the recording
+            queryset = queryset.filter(removed_from_twilio=True)
+        return queryset.order_by('last_activity', 'id').values(*fields)
+
+    def archive_path(self, kind, now):
+        return os.path.join(self.archive_dir, '{}-{}.ndjson.gz'.format(
+            kind, now.strftime('%Y%m%dT%H%M%S')))
+
+    def sweep(self, kind, now):
+        ''' Archives and deletes the expired rows of kind, batch_size at a
+        time. Returns the number of rows archived.'''
+        model = history_kinds[kind][0]
+        expired = self.expired(kind, now)
+        count = 0
+        archive = None
+        try:
+            while True:
+                with transaction.atomic():
+                    batch = list(expired[:self.batch_size])
+                    if len(batch) == 0:
+                        break
+                    if archive is None:
+                        os.makedirs(self.archive_dir, exist_ok=True)
+                        archive = gzip.open(self.archive_path(kind, now),
+                                            'xt', encoding='utf-8')
+                    archive.writelines(render_ndjson(kind, batch))
+                    archive.flush()
+                    # delete only what was written, if the delete fails the
+                    # rows are archived again on the next run
+                    model.objects.filter(
+                        pk__in=[row['id'] for row in batch]).delete()
+                count += len(batch)
+                renew_lease(self.job_id, self.lease_duration)
+        finally:
+            if archive is not None:
+                archive.close()
+        if count:
+            logger.info("Archived {} {} rows".format(count, kind))
+        return count
+
+    def run(self):
+        now = timezone.now()
+        return {kind: self.sweep(kind, now) for kind in self.days}
@@ -1,70 +1,226 @@
 import logging
+import os
+import socket
+import threading
+import time
+import uuid
 
 from apscheduler.schedulers.background import BackgroundScheduler
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from django.conf import settings
+from django.core import mail
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
 from django.utils import timezone
 from twilio.base.exceptions import TwilioRestException
 
-from .models import Voicemail
-from .utils import twilio_client
+from .models import JobLease, Voicemail
+from .utils import RateLimiter, twilio_client
 
 
 logger = logging.getLogger(__name__)
 
+# Started by start_scheduler(), so importing the app does not spawn threads
 scheduler = BackgroundScheduler()
-scheduler.start()
+_start_lock = threading.Lock()
+
+worker_id = '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                              uuid.uuid4().hex[:8])
+
+
+def acquire_lease(name, duration, every=None):
+    ''' Returns True when this process now holds the lease for the job name.
+
+    The lease is taken with a conditional update, so only one process gets
+    it. With every, the lease is only given once the job last ran that long
+    ago.'''
+    JobLease.objects.get_or_create(name=name)
+    now = timezone.now()
+    available = JobLease.objects.filter(
+            Q(expires__isnull=True) | Q(expires__lte=now), name=name)
+    if every is not None:
+        available = available.filter(
+                Q(last_run__isnull=True) | Q(last_run__lte=now - every))
+    return available.update(owner=worker_id, expires=now + duration) == 1
+
+
+def renew_lease(name, duration):
+    return JobLease.objects.filter(name=name, owner=worker_id) \
+        .update(expires=timezone.now() + duration) == 1
+
+
+def release_lease(name, succeeded=True):
+    ''' Only a successful run counts as the last run, so a failed job is
+    retried on the next check.'''
+    fields = dict(expires=None)
+    if succeeded:
+        fields['last_run'] = timezone.now()
+    JobLease.objects.filter(name=name, owner=worker_id).update(**fields)
+
+
+def run_exclusive(name, func, duration, every=None):
+    ''' Calls func() unless another process holds the lease for name.
+
+    Returns True when func was called.'''
+    if not acquire_lease(name, duration, every):
+        return False
+    succeeded = False
+    try:
+        func()
+        succeeded = True
+    finally:
+        release_lease(name, succeeded)
+    return True
 
 
 class VoicemailChecker:
     job_id = 'voicemail_check'
     not_found_code = 20404
+    too_many_requests_code = 20429
+    batch_size = 500
+    retries = 3
+    retry_delay = 1.0
+    # every worker checks hourly, the sweep runs in one of them once a day
+    check_interval = timedelta(hours=1)
+    run_interval = timedelta(days=1)
+    lease_duration = timedelta(minutes=30)
 
     def __init__(self, interval):
         self.interval = interval
         self.interval_diff = timedelta(days=interval)
-        self.initial_check_complete = False
+        self.workers = getattr(
+                settings, 'TWILIO_CALL_CENTER_VOICEMAIL_DELETE_WORKERS', 4)
+        self.rate_limiter = RateLimiter(getattr(
+                settings, 'TWILIO_CALL_CENTER_VOICEMAIL_DELETE_RATE', 10))
 
     @classmethod
-    def begin(cls):
+    def from_settings(cls):
         voicemail_lifespan = getattr(
                 settings, 'TWILIO_CALL_CENTER_VOICEMAIL_LIFESPAN', None)
 
         if voicemail_lifespan is None:
-            return
+            return None
         if voicemail_lifespan <= 0:
             raise ImproperlyConfigured(
                     "TWILIO_CALL_CENTER_VOICEMAIL_LIFESPAN must be integer greater than 0")
+        return cls(voicemail_lifespan)
+
+    @classmethod
+    def begin(cls):
+        checker = cls.from_settings()
+        if checker is None:
+            return
+        scheduler.add_job(checker.check, 'interval', replace_existing=True,
+                          seconds=cls.check_interval.total_seconds(),
+                          id=cls.job_id)
 
-        checker = cls(voicemail_lifespan)
-        scheduler.add_job(checker.run, 'interval', replace_existing=True,
-                          hours=1, id=cls.job_id)
+    def check(self):
+        return run_exclusive(self.job_id, self.run, self.lease_duration,
+                             every=self.run_interval)
 
     def run(self):
-        if not self.initial_check_complete:
-            self.initial_check_complete = True
-            scheduler.reschedule_job(self.job_id, trigger='interval', days=1)
-
-        for voicemail in Voicemail.objects.filter(removed_from_twilio=False):
-            voicemail_expires = voicemail.last_activity + self.interval_diff
-            if timezone.now() >= voicemail_expires:
-                deleted = False
-                try:
-                    twilio_client.recordings(voicemail.sid).delete()
-                    deleted = True
-                except TwilioRestException as e:
-                    if e.code == self.not_found_code:
-                        deleted = True
-                    else:
-                        logger.error("Failed deleting recording " +
-                                     voicemail.sid)
-                        logger.error(str(e))
-
-                if deleted:
-                    voicemail.removed_from_twilio = True
-                    voicemail.save()
-
-
-def one_time_startup():
-    VoicemailChecker.begin()
+        expires = timezone.now() - self.interval_diff
+        expired = Voicemail.objects.filter(removed_from_twilio=False,
+                                           last_activity__lte=expires) \
+            .order_by('last_activity', 'pk') \
+            .only('pk', 'sid', 'last_activity')
+        last = None
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                batch = expired
+                if last is not None:
+                    # continue after the last row, the rows which failed to
+                    # delete are still expired
+                    batch = batch.filter(
+                            Q(last_activity__gt=last.last_activity) |
+                            Q(last_activity=last.last_activity,
+                              pk__gt=last.pk))
+                batch = list(batch[:self.batch_size])
+                if len(batch) == 0:
+                    break
+                self.remove_recordings(executor, batch)
+                last = batch[-1]
+                renew_lease(self.job_id, self.lease_duration)
+
+    def should_retry(self, e):
+        return e.code == self.too_many_requests_code or e.status == 429 or \
+            e.status >= 500
+
+    def delete_recording(self, sid):
+        ''' Returns True when the recording no longer exists on twilio.'''
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait()
+            try:
+                twilio_client.recordings(sid).delete()
+            except TwilioRestException as e:
+                if e.code == self.not_found_code:
+                    return True
+                if attempt < self.retries and self.should_retry(e):
+                    time.sleep(self.retry_delay * 2 ** attempt)
+                    continue
+                logger.error("Failed deleting recording " + sid)
+                logger.error(str(e))
+                return False
+            return True
+
+    def remove_recordings(self, executor, voicemails):
+        results = executor.map(self.delete_recording,
+                               [voicemail.sid for voicemail in voicemails])
+        removed = [voicemail.pk
+                   for voicemail, deleted in zip(voicemails, results)
+                   if deleted]
+        if len(removed):
+            Voicemail.objects.filter(pk__in=removed) \
+                .update(removed_from_twilio=True)
+
+
+def scheduler_mode():
+    return getattr(settings, 'TWILIO_CALL_CENTER_SCHEDULER', 'web')
+
+
+def check_scheduler_settings():
+    ''' Raises ImproperlyConfigured for the settings of the periodic jobs, so
+    AppConfig.ready() fails at startup rather than the first request.'''
+    from .retention import RetentionSweeper
+
+    VoicemailChecker.from_settings()
+    RetentionSweeper.from_settings()
+
+
+def start_scheduler():
+    ''' Adds the periodic jobs and starts the scheduler, once per process.
+
+    Returns False when the scheduler was already running.'''
+    from .campaigns import CampaignSender
+    from .notifications import NotificationDispatcher
+    from .retention import RetentionSweeper
+
+    with _start_lock:
+        if scheduler.running:
+            return False
+        # every job is added before starting, so a settings error never
+        # leaves a running scheduler without the other jobs
+        try:
+            VoicemailChecker.begin()
+            RetentionSweeper.begin()
+            NotificationDispatcher.begin()
+            CampaignSender.begin()
+        except Exception:
+            scheduler.remove_all_jobs()
+            raise
+        scheduler.start()
+    return True
+
+
+def under_test_runner():
+    # the test runner sets up mail.outbox until it tears down
+    return hasattr(mail, 'outbox')
+
+
+def start_on_request(**kwargs):
+    ''' request_started receiver, starts the scheduler in the first process
+    that serves a request. The test client never starts it.'''
+    if scheduler.running or scheduler_mode() != 'web' or under_test_runner():
+        return
+    start_scheduler()
@@ -0,0 +1,110 @@
+''' Optional write-behind buffer for the SMS status callbacks.
+
+The callbacks for a message are merged in memory and written together with
+upsert_sms_messages() at most window seconds later. The updates still in the
+buffer are lost if the process is killed, so this is only enabled with
+TWILIO_CALL_CENTER_SMS_CALLBACK_BUFFER.
+'''
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+from .sms_upsert import merge_message, upsert_sms_messages
+
+
+logger = logging.getLogger(__name__)
+
+
+class SmsStatusBuffer:
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+
+    def add(self, message):
+        ''' Buffers the status callback message. When the buffer is full, it
+        is written by the calling thread instead of waiting for the timer.'''
+        with self._lock:
+            self._pending[message['sid']] = merge_message(
+                    self._pending.get(message['sid'], None), message)
+            overflow = len(self._pending) >= self.max_size
+            if not overflow:
+                self._start_timer()
+        if overflow:
+            self.flush()
+
+    def _start_timer(self):
+        if self._timer is None:
+            self._timer = threading.Timer(self.window, self.flush_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def restore(self, messages):
+        ''' Puts back the messages of a failed write, merged with the ones
+        buffered since, and writes them again after the window.'''
+        with self._lock:
+            for message in messages:
+                newer = self._pending.get(message['sid'], None)
+                self._pending[message['sid']] = message if newer is None \
+                    else merge_message(message, newer)
+            self._start_timer()
+
+    def take(self):
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending = {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            return pending
+
+    def flush(self):
+        ''' Writes the buffered callbacks now, returns how many were written.'''
+        pending = self.take()
+        if len(pending):
+            try:
+                upsert_sms_messages(pending, status_only=True)
+            except Exception:
+                self.restore(pending)
+                raise
+        return len(pending)
+
+    def flush_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error("Failed writing buffered SMS status callbacks")
+            logger.error(str(e))
+        finally:
+            # this thread's connection would otherwise never be closed
+            connections.close_all()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+
+_buffer_lock = threading.Lock()
+_buffer = None
+
+
+def sms_status_buffer():
+    ''' Returns the process wide SmsStatusBuffer, or None when buffering is
+    disabled.'''
+    global _buffer
+    window = getattr(settings, 'TWILIO_CALL_CENTER_SMS_CALLBACK_BUFFER', None)
+    if not window:
+        return None
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = SmsStatusBuffer(window, getattr(
+                settings, 'TWILIO_CALL_CENTER_SMS_CALLBACK_BUFFER_SIZE', 1000))
+            atexit.register(_buffer.flush)
+        return _buffer
@@ -0,0 +1,141 @@
+''' Creates or updates SmsMessage rows by sid in one statement.
+
+Twilio sends several status callbacks for each message, and they can arrive
+out of order. A status only replaces the stored one when it is not earlier
+in the life of the message, so a late "sent" never overwrites "delivered".
+'''
+from django.db import connections, router, transaction
+
+from .models import SmsMessage
+from .utils import normalize_phone_number
+
+
+# The order of the twilio message statuses, the final ones rank highest
+status_ranks = {
+    'accepted': 1,
+    'scheduled': 1,
+    'queued': 2,
+    'sending': 3,
+    'receiving': 3,
+    'sent': 4,
+    'canceled': 5,
+    'delivered': 5,
+    'failed': 5,
+    'received': 5,
+    'undelivered': 5,
+    'read': 6,
+}
+
+data_fields = ['from_phone', 'to_phone', 'from_phone_e164', 'to_phone_e164',
+               'message']
+# 8 parameters per row, well below the SQLite limit
+rows_per_statement = 100
+
+
+def status_rank(status):
+    ''' Unknown statuses rank lowest and never replace a known one.'''
+    return status_ranks.get(status, 0)
+
+
+def merge_message(previous, message):
+    ''' Returns previous updated by a later message with the same sid,
+    keeping its data, the highest ranked status and the last activity.'''
+    if previous is None:
+        return dict(message)
+    if status_rank(message['status']) >= status_rank(previous['status']):
+        previous['status'] = message['status']
+    previous['last_activity'] = max(previous['last_activity'],
+                                    message['last_activity'])
+    return previous
+
+
+def coalesce(messages):
+    ''' Merges the messages with the same sid into one.'''
+    merged = {}
+    for message in messages:
+        merged[message['sid']] = merge_message(
+                merged.get(message['sid'], None), message)
+    for message in merged.values():
+        for field in ['from_phone', 'to_phone']:
+            message[field + '_e164'] = normalize_phone_number(message[field])
+    return list(merged.values())
+
+
+def rank_sql(column):
+    cases = ' '.join("WHEN '{}' THEN {}".format(status, rank)
+                     for status, rank in sorted(status_ranks.items()))
+    return 'CASE {} {} ELSE 0 END'.format(column, cases)
+
+
+def upsert_sql(connection, count, status_only):
+    quote = connection.ops.quote_name
+    table = quote(SmsMessage._meta.db_table)
+    columns = ['sid', 'status', 'last_activity'] + data_fields
+    updates = [
+        '{status} = CASE WHEN {new} >= {old} THEN excluded.{status} '
+        'ELSE {table}.{status} END'.format(
+            status=quote('status'), table=table,
+            new=rank_sql('excluded.' + quote('status')),
+            old=rank_sql(table + '.' + quote('status'))),
+        '{activity} = CASE WHEN excluded.{activity} > {table}.{activity} '
+        'THEN excluded.{activity} ELSE {table}.{activity} END'.format(
+            activity=quote('last_activity'), table=table),
+    ]
+    if not status_only:
+        updates += ['{0} = excluded.{0}'.format(quote(field))
+                    for field in data_fields]
+    row = '({})'.format(', '.join(['%s'] * len(columns)))
+    return 'INSERT INTO {} ({}) VALUES {} ON CONFLICT ({}) DO UPDATE ' \
+        'SET {}'.format(table, ', '.join(map(quote, columns)),
+                        ', '.join([row] * count), quote('sid'),
+                        ', '.join(updates)), columns
+
+
+def upsert_fallback(messages, status_only, using):
+    ''' Row at a time version, for databases without ON CONFLICT.'''
+    with transaction.atomic(using=using):
+        for message in messages:
+            existing = SmsMessage.objects.using(using) \
+                .select_for_update().filter(sid=message['sid']).first()
+            if existing is None:
+                SmsMessage.objects.using(using).create(**message)
+                continue
+            fields = []
+            if message['last_activity'] > existing.last_activity:
+                fields.append('last_activity')
+            if status_rank(message['status']) >= \
+                    status_rank(existing.status):
+                fields.append('status')
+            if not status_only:
+                fields += data_fields
+            if fields:
+                SmsMessage.objects.using(using).filter(pk=existing.pk) \
+                    .update(**{field: message[field] for field in fields})
+
+
+def upsert_sms_messages(messages, status_only=False):
+    ''' Creates or updates the SmsMessage for each dict of sid, from_phone,
+    to_phone, message, status and last_activity.
+
+    With status_only, existing rows only get the status and last activity,
+    like for a status callback which does not repeat the message body.'''
+    messages = coalesce(messages)
+    if len(messages) == 0:
+        return
+    using = router.db_for_write(SmsMessage)
+    connection = connections[using]
+    if not connection.features.supports_update_conflicts_with_target:
+        upsert_fallback(messages, status_only, using)
+        return
+
+    with connection.cursor() as cursor:
+        for start in range(0, len(messages), rows_per_statement):
+            chunk = messages[start:start + rows_per_statement]
+            sql, columns = upsert_sql(connection, len(chunk), status_only)
+            params = []
+            field_objects = [SmsMessage._meta.get_field(c) for c in columns]
+            for message in chunk:
+                params += [field.get_db_prep_save(message[field.name],
+                                                  connection)
+                           for field in field_objects]
+            cursor.execute(sql, params)
@@ -1,5 +1,71 @@
-from django.test import TestCase
-from twilio_call_center.models import MailboxNumber
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib import import_module
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib import admin
+from django.contrib.auth.models import Permission, User
+from django.core import mail
+from django.core.checks import run_checks
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase, override_settings
+from django.urls import include, path
+from django.utils import timezone
+from twilio.base.exceptions import TwilioRestException
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+from twilio_call_center.actions import LazyActionFunctions, action_function
+from twilio_call_center.apps import my_app
+from twilio_call_center.campaigns import CampaignSender, add_recipients, \
+    pause_campaign
+from twilio_call_center.cache import find_twilio_number, menu_cache, \
+    shared_cache
+from twilio_call_center.checks import check_action_functions
+from twilio_call_center.history import history_queryset, iter_history
+from twilio_call_center.instrumentation import get_action_metrics, \
+    get_metrics, install_twilio_hook, instrument_view, render_metrics, reset_metrics
+from twilio_call_center.utils import RateLimiter, clear_phone_cache, \
+    normalize_phone_number, phone_cache_info, twilio_concurrency, \
+    twilio_fan_out
+from twilio_call_center.views import render_call_menu, render_sms_email, \
+    send_voicemail_notifications
+from twilio_call_center.models import MailboxNumber, Menu, MenuItem, \
+    JobLease, Notification, SmsCampaign, SmsCampaignRecipient, SmsMessage, TwilioNumber, Voice, Voicemail
+from twilio_call_center.notifications import NotificationDispatcher
+from twilio_call_center.retention import RetentionSweeper
+from twilio_call_center.sms_buffer import SmsStatusBuffer
+from twilio_call_center.sms_upsert import upsert_sms_messages
+from twilio_call_center.schedule import VoicemailChecker, acquire_lease, \
+    run_exclusive, start_scheduler
+
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('call-center/', include('twilio_call_center.urls')),
+]
+
+class AsyncUrls:
+    urlpatterns = [
+        path('call-center/', include('twilio_call_center.async_urls')),
+    ]
+
+twilio_test_settings = override_settings(
+        ROOT_URLCONF=__name__,
+        DJANGO_TWILIO_FORGERY_PROTECTION=False,
+        DJANGO_TWILIO_BLACKLIST_CHECK=False)
+
 
 class MailboxTestCase(TestCase):
     def setUp(self):
@@ -24,3 +90,1410 @@ class MailboxTestCase(TestCase):
     def test_not_always_send_to_paul_voicemail(self):
         paul = MailboxNumber.objects.get(name='paul')
         self.assertFalse(paul.should_send_voicemail())
+
+
+@twilio_test_settings
+class MenuCacheTestCase(TestCase):
+    def setUp(self):
+        voice = Voice.objects.create(voice='man')
+        self.menu = Menu.objects.create(name='main', greeting_text='Hello',
+                                        voice=voice)
+        submenu = Menu.objects.create(name='sub')
+        mailbox = MailboxNumber.objects.create(name='sales',
+                                               phone='720-201-0123')
+        MenuItem.objects.create(menu=self.menu, menu_digit=1,
+                                menu_text='for sales', action_mailbox=mailbox)
+        MenuItem.objects.create(menu=self.menu, menu_digit=2,
+                                menu_text='for more', action_submenu=submenu)
+        MenuItem.objects.create(menu=submenu, menu_digit=1,
+                                action_text='Sub menu')
+
+    def test_digit_press_uses_no_queries(self):
+        self.client.post('/call-center/main/call-menu')
+        with self.assertNumQueries(0):
+            response = self.client.post('/call-center/main/call-action',
+                                        {'Digits': '1'})
+        self.assertContains(response, '<Dial>720-201-0123</Dial>')
+        self.assertContains(response, 'voice="man"')
+
+    def test_submenu_redirect(self):
+        response = self.client.post('/call-center/main/call-action',
+                                    {'Digits': '2'})
+        self.assertContains(response, '/call-center/sub/call-menu')
+
+    def test_save_invalidates(self):
+        self.client.post('/call-center/main/call-menu')
+        version = menu_cache.current_version()
+        self.menu.greeting_text = 'Welcome'
+        self.menu.save()
+        self.assertNotEqual(version, menu_cache.current_version())
+        response = self.client.post('/call-center/main/call-menu')
+        self.assertContains(response, 'Welcome.')
+
+    def test_disabled_menu_not_found(self):
+        self.client.post('/call-center/main/call-menu')
+        self.menu.enabled = False
+        self.menu.save()
+        response = self.client.post('/call-center/main/call-menu')
+        self.assertEqual(response.status_code, 404)
+
+    def test_unknown_menu_not_stored(self):
+        for name in ['nope-1', 'nope-2']:
+            response = self.client.post('/call-center/{}/call-menu'
+                                        .format(name))
+            self.assertEqual(response.status_code, 404)
+        self.assertNotIn('nope-1', menu_cache._values)
+        self.assertNotIn('nope-2', menu_cache._values)
+
+    def test_non_digit_entry(self):
+        response = self.client.post('/call-center/main/call-action',
+                                    {'Digits': '*'})
+        self.assertContains(response, '/call-center/main/call-menu')
+
+
+@twilio_test_settings
+class TwimlCacheTestCase(TestCase):
+    def setUp(self):
+        self.menu = Menu.objects.create(name='main')
+        MenuItem.objects.create(menu=self.menu, menu_digit=1,
+                                menu_text='for the office',
+                                action_text='Office hours are 9 to 5',
+                                pin_digits_list='1234')
+
+    def post(self, url, **data):
+        return self.client.post('/call-center/main/' + url, data)
+
+    def test_call_menu_matches_rendered(self):
+        response = self.post('call-menu')
+        self.assertEqual(response.content,
+                         str(render_call_menu('main')).encode())
+        self.assertEqual(response['Content-Type'], 'application/xml')
+
+    def test_pin_prompt(self):
+        response = self.post('call-action', Digits='1')
+        self.assertContains(response, 'Enter your pin followed by pound.')
+        self.assertContains(response, '/call-center/main/call-pin/1')
+
+    def test_invalid_pin(self):
+        response = self.post('call-pin/1', Digits='4321')
+        self.assertContains(response, 'Invalid entry.')
+        self.assertContains(response, '<Redirect>/call-center/main/call-menu')
+
+    def test_valid_pin(self):
+        response = self.post('call-pin/1', Digits='1234')
+        self.assertContains(response, 'Office hours are 9 to 5.')
+
+    def test_rendered_once_per_version(self):
+        self.post('call-end')
+        with self.assertNumQueries(0):
+            response = self.post('call-end')
+        self.assertContains(response, 'Goodbye.')
+        self.menu.voice = Voice.objects.create(voice='alice')
+        self.menu.save()
+        self.assertContains(self.post('call-end'), 'voice="alice"')
+
+
+class TwilioNumberIndexTestCase(TestCase):
+    def setUp(self):
+        self.number = TwilioNumber.objects.create(name='office',
+                                                  phone='(720) 201-0123')
+
+    def test_normalized_column(self):
+        self.assertEqual(self.number.phone_e164, '+17202010123')
+
+    def test_lookup_by_any_format(self):
+        find_twilio_number('+17202010123')
+        with self.assertNumQueries(0):
+            self.assertEqual(find_twilio_number('+17202010123'), self.number)
+            self.assertEqual(find_twilio_number('720.201.0123'), self.number)
+            self.assertEqual(find_twilio_number('(720) 201-0123'),
+                             self.number)
+            self.assertIsNone(find_twilio_number('+17202010124'))
+            self.assertIsNone(find_twilio_number('unknown'))
+
+    def test_new_number_is_found(self):
+        self.assertIsNone(find_twilio_number('+17202010124'))
+        number = TwilioNumber.objects.create(name='sales',
+                                             phone='720-201-0124')
+        self.assertEqual(find_twilio_number('+17202010124'), number)
+
+
+@twilio_test_settings
+class TwilioNumberListFilterTestCase(TestCase):
+    def setUp(self):
+        self.number = TwilioNumber.objects.create(name='office',
+                                                  phone='720-201-0123')
+        for i, (from_phone, to_phone) in enumerate([
+                ('+13035550100', '+17202010123'),
+                ('(720) 201-0123', '303-555-0100'),
+                ('+13035550100', '+17202010199')]):
+            SmsMessage.objects.create(sid='SM{}'.format(i),
+                                      from_phone=from_phone,
+                                      to_phone=to_phone,
+                                      message='hi', status='received',
+                                      last_activity=timezone.now())
+        self.client.force_login(User.objects.create_superuser('admin'))
+
+    def test_filter_matches_normalized_numbers(self):
+        response = self.client.get(
+                '/admin/twilio_call_center/smsmessage/',
+                {'twilio_number': self.number.pk})
+        sids = sorted(m.sid for m in response.context['cl'].queryset)
+        self.assertEqual(sids, ['SM0', 'SM1'])
+
+
+class PhoneCacheTestCase(TestCase):
+    def setUp(self):
+        clear_phone_cache()
+
+    def test_hits_and_misses(self):
+        self.assertEqual(normalize_phone_number('720-201-0123'), '+17202010123')
+        self.assertEqual(normalize_phone_number('720-201-0123'), '+17202010123')
+        info = phone_cache_info()['normalize']
+        self.assertEqual(info['misses'], 1)
+        self.assertEqual(info['hits'], 1)
+
+    def test_default_country_change(self):
+        self.assertNotEqual(normalize_phone_number('020 7946 0018'),
+                            '+442079460018')
+        with self.settings(TWILIO_CALL_CENTER_DEFAULT_COUNTRY='GB'):
+            self.assertEqual(phone_cache_info()['normalize']['currsize'], 0)
+            self.assertEqual(normalize_phone_number('020 7946 0018'),
+                             '+442079460018')
+
+
+class FakeRecordings:
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.deleted = []
+
+    def __call__(self, sid):
+        recordings = self
+
+        class Recording:
+            def delete(self):
+                if sid in recordings.errors:
+                    raise TwilioRestException(
+                            404, 'uri', code=recordings.errors[sid])
+                recordings.deleted.append(sid)
+                return True
+        return Recording()
+
+
+class VoicemailCheckerTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        for sid, age in [('RE1', 10), ('RE2', 10), ('RE3', 10), ('RE4', 1),
+                         ('RE5', 10)]:
+            Voicemail.objects.create(sid=sid, call_sid='CA' + sid,
+                                     from_phone='720-201-0123',
+                                     to_phone='720-201-0124',
+                                     status='completed',
+                                     last_activity=now - timedelta(days=age))
+        self.checker = VoicemailChecker(7)
+        self.checker.batch_size = 2
+        self.checker.rate_limiter = RateLimiter(None)
+
+    def removed(self):
+        return sorted(Voicemail.objects.filter(removed_from_twilio=True)
+                      .values_list('sid', flat=True))
+
+    def test_removes_expired_recordings(self):
+        recordings = FakeRecordings({'RE2': 20404, 'RE3': 20001})
+        client = mock.Mock(recordings=recordings)
+        with mock.patch('twilio_call_center.schedule.twilio_client', client):
+            with self.assertLogs('twilio_call_center.schedule', 'ERROR'):
+                self.checker.run()
+        self.assertEqual(recordings.deleted, ['RE1', 'RE5'])
+        self.assertEqual(self.removed(), ['RE1', 'RE2', 'RE5'])
+
+    def test_check_runs_once_a_day(self):
+        client = mock.Mock(recordings=FakeRecordings())
+        with mock.patch('twilio_call_center.schedule.twilio_client', client):
+            self.assertTrue(self.checker.check())
+            self.assertFalse(VoicemailChecker(7).check())
+        self.assertEqual(len(self.removed()), 4)
+        lease = JobLease.objects.get(name=VoicemailChecker.job_id)
+        self.assertIsNone(lease.expires)
+        self.assertIsNotNone(lease.last_run)
+
+
+class JobLeaseTestCase(TestCase):
+    def test_one_holder(self):
+        self.assertTrue(acquire_lease('job', timedelta(minutes=1)))
+        self.assertFalse(acquire_lease('job', timedelta(minutes=1)))
+        JobLease.objects.filter(name='job').update(
+                expires=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(acquire_lease('job', timedelta(minutes=1)))
+
+    def test_run_exclusive_releases(self):
+        calls = []
+        with self.assertRaises(ValueError):
+            run_exclusive('job', lambda: calls.append(1) or int('x'),
+                          timedelta(minutes=1))
+        self.assertTrue(run_exclusive('job', lambda: calls.append(2),
+                                      timedelta(minutes=1)))
+        self.assertFalse(run_exclusive('job', lambda: calls.append(3),
+                                       timedelta(minutes=1),
+                                       every=timedelta(hours=1)))
+        self.assertEqual(calls, [1, 2])
+
+    def test_failed_run_is_retried(self):
+        calls = []
+        every = timedelta(days=1)
+        with self.assertRaises(ValueError):
+            run_exclusive('job', lambda: calls.append(1) or int('x'),
+                          timedelta(minutes=1), every=every)
+        self.assertIsNone(JobLease.objects.get(name='job').last_run)
+        self.assertTrue(run_exclusive('job', lambda: calls.append(2),
+                                      timedelta(minutes=1), every=every))
+        self.assertFalse(run_exclusive('job', lambda: calls.append(3),
+                                       timedelta(minutes=1), every=every))
+        self.assertEqual(calls, [1, 2])
+
+
+class WorkerCommandTestCase(TestCase):
+    command = 'twilio_call_center.management.commands.run_call_center_worker'
+
+    def test_runs_scheduler_until_interrupted(self):
+        with mock.patch(self.command + '.start_scheduler') as start, \
+                mock.patch(self.command + '.scheduler') as scheduler, \
+                mock.patch(self.command + '.time') as time_module:
+            time_module.sleep.side_effect = [None, KeyboardInterrupt]
+            call_command('run_call_center_worker', stdout=StringIO())
+        start.assert_called_once_with()
+        scheduler.shutdown.assert_called_once_with()
+        self.assertEqual(time_module.sleep.call_count, 2)
+
+    @override_settings(TWILIO_CALL_CENTER_SMS_RETENTION=30)
+    def test_bad_settings_do_not_start_scheduler(self):
+        with mock.patch('twilio_call_center.schedule.scheduler') as s:
+            s.running = False
+            with self.assertRaises(ImproperlyConfigured):
+                start_scheduler()
+        s.start.assert_not_called()
+        s.remove_all_jobs.assert_called_once_with()
+
+    def test_requests_do_not_start_scheduler_under_tests(self):
+        with mock.patch('twilio_call_center.schedule.start_scheduler') as s:
+            self.client.get('/call-center/no-menu/call-menu')
+        s.assert_not_called()
+
+    def test_dispatch_soon_without_scheduler(self):
+        with mock.patch('twilio_call_center.notifications.scheduler') as s:
+            s.running = False
+            NotificationDispatcher.dispatch_soon()
+        s.add_job.assert_not_called()
+
+
+class StubTwilioHandler(BaseHTTPRequestHandler):
+    ''' Answers recording deletes like the twilio API, after a delay.'''
+    def do_DELETE(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.peak_in_flight = max(server.peak_in_flight,
+                                        server.in_flight)
+        time.sleep(server.delay)
+        sid = self.path.rsplit('/', 1)[-1].split('.')[0]
+        with server.lock:
+            server.in_flight -= 1
+            server.requests.append(sid)
+            errors = server.errors.get(sid, [])
+            error = errors.pop(0) if len(errors) else None
+        if error is None:
+            self.send_response(204)
+            self.end_headers()
+            return
+        status, code = error
+        body = json.dumps({'code': code, 'message': 'error',
+                           'status': status}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubHttpClient(TwilioHttpClient):
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        url = url.replace('https://api.twilio.com', self.base_url)
+        return super().request(method, url, *args, **kwargs)
+
+
+class VoicemailDeletionThroughputTestCase(TestCase):
+    count = 20
+    delay = 0.1
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubTwilioHandler)
+        self.server.delay = self.delay
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.errors = {}
+        self.server.in_flight = 0
+        self.server.peak_in_flight = 0
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        base_url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        client = Client('AC' + '0' * 32, 'token',
+                        http_client=StubHttpClient(base_url))
+        patcher = mock.patch('twilio_call_center.schedule.twilio_client',
+                             client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        last_activity = timezone.now() - timedelta(days=10)
+        Voicemail.objects.bulk_create([
+            Voicemail(sid='RE{}'.format(i), call_sid='CA{}'.format(i),
+                      from_phone='720-201-0123', to_phone='720-201-0124',
+                      status='completed', last_activity=last_activity)
+            for i in range(self.count)])
+
+    def run_checker(self, workers):
+        with self.settings(TWILIO_CALL_CENTER_VOICEMAIL_DELETE_WORKERS=workers,
+                           TWILIO_CALL_CENTER_VOICEMAIL_DELETE_RATE=None):
+            checker = VoicemailChecker(7)
+        checker.retry_delay = 0.01
+        start = time.monotonic()
+        checker.run()
+        return self.count / (time.monotonic() - start)
+
+    def test_concurrent_deletions_per_second(self):
+        rate = self.run_checker(workers=10)
+        self.assertGreater(self.server.peak_in_flight, 1)
+        self.assertGreater(rate, 1 / self.delay)
+        self.assertEqual(Voicemail.objects.filter(
+            removed_from_twilio=False).count(), 0)
+
+    def test_retry_and_not_found(self):
+        self.server.errors = {
+            'RE1': [(429, 20429), (503, 20500)],
+            'RE2': [(404, 20404)],
+            'RE3': [(400, 21000)],
+        }
+        with self.assertLogs('twilio_call_center.schedule', 'ERROR'):
+            self.run_checker(workers=4)
+        self.assertEqual(self.server.requests.count('RE1'), 3)
+        self.assertEqual(self.server.requests.count('RE3'), 1)
+        self.assertEqual(list(Voicemail.objects.filter(
+            removed_from_twilio=False).values_list('sid', flat=True)),
+            ['RE3'])
+
+
+@twilio_test_settings
+class NotificationQueueTestCase(TestCase):
+    def setUp(self):
+        self.number = TwilioNumber.objects.create(
+                name='office', phone='720-201-0123',
+                forward_phone_list='303-555-0100, 303-555-0101',
+                forward_email_list='office@example.com')
+        mailbox = MailboxNumber.objects.create(
+                name='sales', email_list='sales@example.com',
+                always_send_voicemail=True)
+        menu = Menu.objects.create(name='main')
+        MenuItem.objects.create(menu=menu, menu_digit=1, menu_text='sales',
+                                action_mailbox=mailbox)
+        self.client_mock = mock.Mock()
+        patcher = mock.patch('twilio_call_center.notifications.twilio_client',
+                             self.client_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_voicemail(self, **data):
+        data.update(RecordingSid='RE1', CallSid='CA1', From='+13035550100',
+                    To='+17202010123', RecordingUrl='https://example.com/RE1',
+                    CallStatus='completed')
+        return self.client.post('/call-center/main/voicemail/1', data)
+
+    def test_sms_incoming_only_enqueues(self):
+        response = self.client.post('/call-center/sms-incoming', {
+            'MessageSid': 'SM1', 'From': '+13035550100',
+            'To': '+17202010123', 'Body': 'Hello'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        self.client_mock.messages.create.assert_not_called()
+        self.assertEqual(Notification.objects.filter(
+            status=Notification.PENDING).count(), 3)
+
+        NotificationDispatcher().run()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['office@example.com'])
+        self.assertEqual(self.client_mock.messages.create.call_count, 2)
+        self.assertEqual(Notification.objects.filter(
+            status=Notification.SENT).count(), 3)
+
+    def test_voicemail_waits_for_transcription(self):
+        self.post_voicemail()
+        notification = Notification.objects.get()
+        self.assertEqual(notification.key, 'transcript-RE1')
+        self.assertGreater(notification.next_attempt, timezone.now())
+        NotificationDispatcher().run()
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.post_voicemail(TranscriptionStatus='completed',
+                            TranscriptionText='Call me back')
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, Notification.CANCELED)
+        NotificationDispatcher().run()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('Call me back', mail.outbox[0].body)
+
+    def test_retry_then_fail(self):
+        self.client_mock.messages.create.side_effect = Exception('down')
+        notification = Notification.objects.create(
+                kind=Notification.SMS, payload={'to': '+13035550100'})
+        dispatcher = NotificationDispatcher()
+        dispatcher.max_attempts = 2
+        dispatcher.run()
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, Notification.PENDING)
+        self.assertEqual(notification.last_error, 'down')
+        self.assertGreater(notification.next_attempt, timezone.now())
+        Notification.objects.update(next_attempt=timezone.now())
+        with self.assertLogs('twilio_call_center.notifications', 'ERROR'):
+            dispatcher.run()
+        notification.refresh_from_db()
+        self.assertEqual(notification.status, Notification.FAILED)
+        self.assertEqual(notification.attempts, 2)
+
+
+class TwilioFanOutTestCase(TestCase):
+    def test_results_and_errors_in_order(self):
+        def create(to):
+            if to == 'bad':
+                raise ValueError(to)
+            return to.upper()
+        results = twilio_fan_out(create, ['a', 'bad', 'c'])
+        self.assertEqual([r for r, _ in results], ['A', None, 'C'])
+        self.assertIsInstance(results[1][1], ValueError)
+
+    def test_concurrency_is_capped(self):
+        lock = threading.Lock()
+        counts = {'in_flight': 0, 'peak': 0}
+
+        def create(to):
+            with lock:
+                counts['in_flight'] += 1
+                counts['peak'] = max(counts['peak'], counts['in_flight'])
+            time.sleep(0.05)
+            with lock:
+                counts['in_flight'] -= 1
+        twilio_fan_out(create, range(12))
+        self.assertGreater(counts['peak'], 1)
+        self.assertLessEqual(counts['peak'], twilio_concurrency())
+
+    def test_rate_limiter_waits_before_submitting(self):
+        waits = []
+        limiter = mock.Mock(wait=lambda: waits.append(
+            threading.current_thread()))
+        results = twilio_fan_out(str.upper, ['a', 'b'], rate_limiter=limiter)
+        self.assertEqual([r for r, _ in results], ['A', 'B'])
+        self.assertEqual(waits, [threading.current_thread()] * 2)
+
+    def test_dispatcher_records_each_recipient(self):
+        client = mock.Mock()
+        client.messages.create.side_effect = \
+            lambda to, **kwargs: to == 'bad' and 1 / 0
+        for to in ['+13035550100', 'bad', '+13035550101']:
+            Notification.objects.create(kind=Notification.SMS,
+                                        payload={'to': to})
+        with mock.patch('twilio_call_center.notifications.twilio_client',
+                        client):
+            NotificationDispatcher().run()
+        statuses = dict(Notification.objects.values_list('payload__to',
+                                                         'status'))
+        self.assertEqual(statuses, {'+13035550100': Notification.SENT,
+                                    'bad': Notification.PENDING,
+                                    '+13035550101': Notification.SENT})
+
+
+class NotificationEmailTestCase(TestCase):
+    def test_sms_email_with_media(self):
+        text, html = render_sms_email({
+            'From': '+13035550100',
+            'Body': 'Look <here>',
+            'NumMedia': '2',
+            'MediaUrl0': 'https://example.com/m0',
+            'MediaContentType0': 'image/png',
+            'MediaUrl1': 'https://example.com/m1',
+            'MediaContentType1': 'audio/mpeg',
+        }, 'office +17202010123')
+        self.assertEqual(text, 'Look <here>\n'
+                               'image/png https://example.com/m0\n'
+                               'audio/mpeg https://example.com/m1\n'
+                               'From: +13035550100\n'
+                               'To: office +17202010123')
+        self.assertIn('Look &lt;here&gt;', html)
+        self.assertIn('alt="image/png" src="https://example.com/m0"', html)
+        self.assertIn('<a href="https://example.com/m1">audio/mpeg</a>', html)
+
+    def test_voicemail_email(self):
+        mailbox = MailboxNumber.objects.create(name='sales',
+                                               email_list='a@example.com')
+        voicemail = Voicemail.objects.create(
+                sid='RE1', call_sid='CA1', mailbox=mailbox,
+                from_phone='+13035550100', to_phone='+17202010123',
+                url='https://example.com/RE1', status='completed',
+                transcription_status='completed', transcription='Hi there',
+                last_activity=timezone.now())
+        send_voicemail_notifications(voicemail, 'example.com')
+        payload = Notification.objects.get().payload
+        self.assertEqual(payload['message'], 'Hello,\n\n'
+            'Call center option [None] mailbox [sales] received voicemail '
+            'from +13035550100.\n\n'
+            'Recording is at https://example.com/RE1\n\n'
+            'Transcription completed:\n'
+            'Hi there')
+        self.assertIn('Transcription completed:<br>\nHi there',
+                      payload['html_message'])
+
+
+@twilio_test_settings
+@override_settings(TWILIO_CALL_CENTER_INSTRUMENTATION=True)
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        reset_metrics()
+        self.addCleanup(reset_metrics)
+        Menu.objects.create(name='main')
+
+    def test_call_end_metrics(self):
+        menu_cache.invalidate()
+        with self.assertLogs('twilio_call_center.instrumentation') as logs:
+            response = self.client.post('/call-center/main/call-end')
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['view'], 'call_end')
+        self.assertEqual(line['status'], 200)
+        self.assertGreater(line['db_queries'], 0)
+        self.assertEqual(line['twilio_calls'], 0)
+        self.assertEqual(line['twiml_bytes'], len(response.content))
+
+        totals = get_metrics()['call_end']
+        self.assertEqual(totals['requests_total'], 1)
+        self.assertEqual(totals['db_queries_total'], line['db_queries'])
+        self.assertIn('twilio_call_center_requests_total{view="call_end"} 1\n',
+                      render_metrics())
+
+    @override_settings(TWILIO_CALL_CENTER_INSTRUMENTATION=False)
+    def test_disabled(self):
+        self.client.post('/call-center/main/call-end')
+        self.assertEqual(get_metrics(), {})
+
+    def test_twilio_calls_counted(self):
+        request = mock.Mock()
+        client = mock.Mock(http_client=SimpleNamespace(request=request))
+        install_twilio_hook(client)
+        install_twilio_hook(client)
+
+        def view(request):
+            client.http_client.request('GET', 'https://example.com')
+            return 'ok'
+
+        with self.assertLogs('twilio_call_center.instrumentation'):
+            instrument_view(view)(None)
+        self.assertEqual(get_metrics()['view']['twilio_calls_total'], 1)
+        client.http_client.request('GET', 'https://example.com')
+        self.assertEqual(get_metrics()['view']['twilio_calls_total'], 1)
+        self.assertEqual(request.call_count, 2)
+
+    async def test_async_view(self):
+        async def view(request):
+            return 'ok'
+
+        with self.assertLogs('twilio_call_center.instrumentation') as logs:
+            self.assertEqual(await instrument_view(view)(None), 'ok')
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['view'], 'view')
+        self.assertEqual(line['db_queries'], 0)
+        self.assertEqual(get_metrics()['view']['requests_total'], 1)
+
+
+@override_settings(ROOT_URLCONF=AsyncUrls,
+                   DJANGO_TWILIO_FORGERY_PROTECTION=False,
+                   DJANGO_TWILIO_BLACKLIST_CHECK=False)
+class AsyncViewsTestCase(TestCase):
+    def setUp(self):
+        self.mailbox = MailboxNumber.objects.create(
+                name='sales', phone='+17202010123', always_send_voicemail=True,
+                email_list='sales@example.com')
+        self.menu = Menu.objects.create(name='main')
+        MenuItem.objects.create(menu=self.menu, menu_digit=1,
+                                menu_text='for the office',
+                                action_text='Office hours are 9 to 5',
+                                pin_digits_list='1234')
+        MenuItem.objects.create(menu=self.menu, menu_digit=2,
+                                menu_text='for sales',
+                                action_mailbox=self.mailbox)
+        TwilioNumber.objects.create(name='office', phone='+17202010100')
+
+    async def post(self, url, **data):
+        return await self.async_client.post('/call-center/' + url, data)
+
+    async def test_call_menu(self):
+        response = await self.post('main/call-menu')
+        self.assertEqual(response['Content-Type'], 'application/xml')
+        self.assertEqual(response.content,
+                         str(render_call_menu('main')).encode())
+
+    async def test_call_action(self):
+        response = await self.post('main/call-action', Digits='1')
+        self.assertContains(response, 'Enter your pin followed by pound.')
+        response = await self.post('main/call-pin/1', Digits='1234')
+        self.assertContains(response, 'Office hours are 9 to 5.')
+        response = await self.post('main/call-action', Digits='2')
+        self.assertContains(response, '/call-center/main/voicemail/2')
+
+    async def test_unknown_menu(self):
+        response = await self.post('other/call-end')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_voicemail(self):
+        response = await self.post(
+                'main/voicemail/2', RecordingSid='RE1', CallSid='CA1',
+                From='+17205550100', To='+17202010100', CallStatus='completed',
+                RecordingUrl='https://api.twilio.com/RE1')
+        self.assertContains(response, 'Thanks for the voicemail.')
+        voicemail = await Voicemail.objects.aget(sid='RE1')
+        self.assertEqual(voicemail.mailbox_id, self.mailbox.id)
+        self.assertTrue(await Notification.objects.filter(
+            kind=Notification.VOICEMAIL).aexists())
+
+    async def test_sms_incoming(self):
+        response = await self.post('sms-incoming', MessageSid='SM1',
+                                   From='+17205550100', To='+17202010100',
+                                   Body='hello', SmsStatus='received')
+        self.assertEqual(response.status_code, 200)
+        message = await SmsMessage.objects.aget(sid='SM1')
+        self.assertEqual(message.message, 'hello')
+        response = await self.post('send-sms-cb', MessageSid='SM1',
+                                   SmsStatus='delivered')
+        self.assertEqual(response.status_code, 204)
+
+    @override_settings(DJANGO_TWILIO_FORGERY_PROTECTION=True)
+    async def test_forged_request(self):
+        response = await self.post('main/call-menu')
+        self.assertEqual(response.status_code, 403)
+
+
+@twilio_test_settings
+class ActionFunctionPolicyTestCase(TestCase):
+    def setUp(self):
+        reset_metrics()
+        self.addCleanup(reset_metrics)
+        shared_cache().clear()
+        self.calls = 0
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        menu = Menu.objects.create(name='main')
+        MenuItem.objects.create(menu=menu, menu_digit=1,
+                                action_function='tests.balance')
+
+    def balance(self, request, response):
+        self.calls += 1
+        response.pause(2)
+        return 'Your balance is {} dollars'.format(self.calls)
+
+    def slow(self, request, response):
+        self.release.wait(5)
+        response.pause(2)
+        return 'Done'
+
+    def nothing(self, request, response):
+        return None
+
+    def press(self, func, policy, caller='+17205550100'):
+        functions = {'tests.balance': action_function('tests.balance', func,
+                                                      policy)}
+        with mock.patch.object(my_app(), 'action_functions', functions):
+            return self.client.post('/call-center/main/call-action',
+                                    dict(Digits='1', From=caller))
+
+    def test_no_policy(self):
+        self.assertEqual(action_function('tests.balance', self.balance),
+                         self.balance)
+
+    def test_cache(self):
+        policy = dict(cache=60)
+        self.assertContains(self.press(self.balance, policy),
+                            'Your balance is 1 dollars')
+        self.assertContains(self.press(self.balance, policy),
+                            'Your balance is 1 dollars')
+        self.assertContains(self.press(self.balance, policy,
+                                       caller='+17205550101'),
+                            'Your balance is 2 dollars')
+        self.assertEqual(get_action_metrics()['tests.balance'], dict(
+            cache_hits_total=1, cache_misses_total=2, timeouts_total=0))
+
+    def test_timeout(self):
+        policy = dict(timeout=0.1, fallback='Try again later', cache=60)
+        with self.assertLogs('twilio_call_center.actions', 'WARNING'):
+            response = self.press(self.slow, policy)
+        self.assertContains(response, 'Try again later.')
+        self.assertNotContains(response, '<Pause length="2"')
+        self.release.set()
+        response = self.press(self.balance, policy)
+        self.assertContains(response, 'Your balance is 1 dollars')
+        self.assertContains(response, '<Pause length="2"')
+        self.assertEqual(
+                get_action_metrics()['tests.balance']['timeouts_total'], 1)
+        self.assertIn('twilio_call_center_action_timeouts_total'
+                      '{function="tests.balance"} 1\n', render_metrics())
+
+    def poll(self, func, policy):
+        functions = {'tests.balance': action_function('tests.balance', func,
+                                                      policy)}
+        with mock.patch.object(my_app(), 'action_functions', functions):
+            return self.client.post('/call-center/main/call-poll/1',
+                                    dict(CallSid='CA1', From='+17205550100'))
+
+    def wait_for_result(self, func, policy, expected=b'<Say'):
+        for _ in range(50):
+            response = self.poll(func, policy)
+            if expected in response.content:
+                return response
+            time.sleep(0.1)
+        self.fail('The background function did not finish')
+
+    def test_background(self):
+        policy = dict(background=True, hold='One moment', poll=2, cache=60)
+        functions = {'tests.balance': action_function('tests.balance',
+                                                      self.slow, policy)}
+        with mock.patch.object(my_app(), 'action_functions', functions):
+            response = self.client.post('/call-center/main/call-action',
+                                        dict(Digits='1', CallSid='CA1',
+                                             From='+17205550100'))
+        self.assertContains(response, 'One moment.')
+        self.assertContains(response,
+                            '<Redirect>/call-center/main/call-poll/1')
+
+        response = self.poll(self.slow, policy)
+        self.assertNotContains(response, '<Say')
+        self.assertContains(response, '<Pause length="2"')
+        self.assertContains(response,
+                            '<Redirect>/call-center/main/call-poll/1')
+
+        self.release.set()
+        response = self.wait_for_result(self.slow, policy)
+        self.assertContains(response, 'Done.')
+        self.assertContains(response, '<Redirect>/call-center/main/call-menu')
+        # the next call gets the cached result without waiting
+        response = self.press(self.slow, policy)
+        self.assertContains(response, 'Done.')
+
+    def test_background_returns_none(self):
+        policy = dict(background=True)
+        functions = {'tests.balance': action_function('tests.balance',
+                                                      self.nothing, policy)}
+        with mock.patch.object(my_app(), 'action_functions', functions):
+            self.client.post('/call-center/main/call-action',
+                             dict(Digits='1', CallSid='CA1'))
+        menu_url = b'<Redirect>/call-center/main/call-menu'
+        response = self.wait_for_result(self.nothing, policy, menu_url)
+        self.assertNotContains(response, '<Say')
+        self.assertNotContains(response, '<Pause')
+
+    def test_background_timeout(self):
+        policy = dict(background=True, timeout=0.1,
+                      fallback='Try again later')
+        functions = {'tests.balance': action_function('tests.balance',
+                                                      self.slow, policy)}
+        with mock.patch.object(my_app(), 'action_functions', functions):
+            self.client.post('/call-center/main/call-action',
+                             dict(Digits='1', CallSid='CA1'))
+        time.sleep(0.2)
+        self.assertContains(self.poll(self.slow, policy), 'Try again later.')
+        self.assertEqual(
+                get_action_metrics()['tests.balance']['timeouts_total'], 1)
+        # the state is gone, a later poll does not wait again
+        self.assertEqual(self.poll(self.slow, policy).status_code, 404)
+
+    def test_poll_needs_started_background_action(self):
+        menu = Menu.objects.get(name='main')
+        mailbox = MailboxNumber.objects.create(name='office',
+                                               phone='+17202010123')
+        MenuItem.objects.create(menu=menu, menu_digit=2,
+                                pin_digits_list='1234',
+                                action_function='tests.balance')
+        MenuItem.objects.create(menu=menu, menu_digit=3,
+                                pin_digits_list='1234',
+                                action_mailbox=mailbox)
+        functions = {'tests.balance': action_function('tests.balance',
+                                                      self.balance)}
+        with mock.patch.object(my_app(), 'action_functions', functions):
+            for digit in ['2', '3']:
+                response = self.client.post(
+                        '/call-center/main/call-poll/' + digit,
+                        dict(CallSid='CA1', Digits='1'))
+                self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.calls, 0)
+        # a background function which call_action did not start
+        policy = dict(background=True)
+        self.assertEqual(self.poll(self.balance, policy).status_code, 404)
+        self.assertEqual(self.calls, 0)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ImproperlyConfigured):
+            action_function('tests.balance', self.balance, dict(ttl=60))
+        with self.assertRaises(ImproperlyConfigured):
+            action_function('tests.balance', self.balance, dict(timeout=0))
+
+
+class LazyActionFunctionsTestCase(TestCase):
+    def setUp(self):
+        self.functions = LazyActionFunctions([
+            ('json', 'dumps'),
+            ('json', 'missing'),
+            ('twilio_call_center.missing', 'function', {'cache': 60}),
+            ('json', 'decoder', {'cache': 60}),
+        ])
+
+    def test_imported_on_first_use(self):
+        with mock.patch('twilio_call_center.actions.import_module',
+                        wraps=import_module) as importer:
+            functions = LazyActionFunctions([('json', 'dumps')])
+            self.assertEqual(list(functions), ['json.dumps'])
+            importer.assert_not_called()
+            self.assertIs(functions['json.dumps'], json.dumps)
+            self.assertIs(functions.get('json.dumps'), json.dumps)
+            self.assertEqual(importer.call_count, 1)
+        self.assertIsNone(functions.get('json.loads'))
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ImproperlyConfigured):
+            LazyActionFunctions([('json', 'dumps', {'ttl': 60})])
+
+    def test_slow_import_does_not_block_other_names(self):
+        importing = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow_import(module):
+            if module == 'slow':
+                importing.set()
+                release.wait(5)
+            return json
+
+        functions = LazyActionFunctions([('slow', 'dumps'), ('json', 'loads')])
+        with mock.patch('twilio_call_center.actions.import_module',
+                        side_effect=slow_import):
+            thread = threading.Thread(target=lambda: functions['slow.dumps'])
+            thread.start()
+            self.assertTrue(importing.wait(5))
+            self.assertIs(functions['json.loads'], json.loads)
+            # the other name was found while the slow import still ran
+            self.assertTrue(thread.is_alive())
+            release.set()
+            thread.join(5)
+        self.assertIs(functions['slow.dumps'], json.dumps)
+
+    def test_check_command(self):
+        out = StringIO()
+        err = StringIO()
+        with mock.patch.object(my_app(), 'action_functions', self.functions), \
+                self.assertLogs('twilio_call_center.actions', 'ERROR'):
+            with self.assertRaisesMessage(CommandError,
+                                          '3 of 4 action functions failed'):
+                call_command('check_action_functions', stdout=out,
+                             stderr=err)
+        self.assertIn('json.dumps: ok', out.getvalue())
+        self.assertIn('json.missing: AttributeError', err.getvalue())
+        self.assertIn('twilio_call_center.missing.function: '
+                      'ModuleNotFoundError', err.getvalue())
+        self.assertIn('json.decoder: Not callable', err.getvalue())
+
+    def test_broken_function_says_fallback(self):
+        with mock.patch('twilio_call_center.actions.import_module',
+                        wraps=import_module) as importer:
+            with self.assertLogs('twilio_call_center.actions', 'ERROR') as logs:
+                for _ in range(2):
+                    func = self.functions['twilio_call_center.missing.function']
+                    self.assertEqual(func(request=None, response=None),
+                                     'Sorry, this is not available right now')
+        self.assertEqual(importer.call_count, 1)
+        self.assertEqual(len(logs.records), 1)
+
+    def test_system_check(self):
+        with mock.patch.object(my_app(), 'action_functions', self.functions), \
+                self.assertLogs('twilio_call_center.actions', 'ERROR'):
+            errors = check_action_functions(None)
+        self.assertEqual([e.id for e in errors],
+                         ['twilio_call_center.E001'] * 3)
+        self.assertIn('json.decoder', errors[0].msg)
+
+    def test_system_check_only_on_deploy(self):
+        with mock.patch.object(my_app(), 'action_functions', self.functions), \
+                mock.patch('twilio_call_center.actions.import_module') as im:
+            run_checks()
+        im.assert_not_called()
+
+
+class MenuImportExportTestCase(TestCase):
+    def setUp(self):
+        voice = Voice.objects.create(voice='alice')
+        number = TwilioNumber.objects.create(name='office',
+                                             phone='720-201-0123')
+        self.mailbox = MailboxNumber.objects.create(
+                name='sales', phone='303-555-0100',
+                notification_phone=number)
+        self.main = Menu.objects.create(name='main', voice=voice)
+        sub = Menu.objects.create(name='sub', greeting_text='Sub menu')
+        MenuItem.objects.create(menu=self.main, menu_digit=1,
+                                action_submenu=sub)
+        MenuItem.objects.create(menu=sub, menu_digit=2,
+                                action_mailbox=self.mailbox)
+
+    def export(self):
+        output = StringIO()
+        call_command('export_menus', stdout=output, stderr=StringIO())
+        return output.getvalue()
+
+    def import_(self, data):
+        with mock.patch('sys.stdin', StringIO(data)):
+            call_command('import_menus', '-', stdout=StringIO())
+
+    def test_round_trip(self):
+        data = self.export()
+        self.assertEqual(len(data.splitlines()), 7)
+        for model in [MenuItem, Menu, MailboxNumber, TwilioNumber, Voice]:
+            model.objects.all().delete()
+
+        self.import_(data)
+        self.assertEqual(self.export(), data)
+        mailbox = MailboxNumber.objects.get(pk=self.mailbox.pk)
+        self.assertEqual(mailbox.phone_e164, '+13035550100')
+        self.assertEqual(TwilioNumber.objects.get().phone_e164,
+                         '+17202010123')
+        self.assertIn('voice="alice"', str(render_call_menu('main')))
+        self.assertEqual(Menu.objects.create(name='new').pk,
+                         Menu.objects.order_by('pk')[1].pk + 1)
+
+    def test_updates_existing(self):
+        data = self.export().replace('303-555-0100', '303-555-0199')
+        render_call_menu('main')
+        self.import_(data.replace('"alice"', '"man"'))
+        self.assertEqual(MailboxNumber.objects.get().phone_e164,
+                         '+13035550199')
+        self.assertIn('voice="man"', str(render_call_menu('main')))
+        self.assertEqual(Menu.objects.count(), 2)
+
+    def test_invalid_row(self):
+        with self.assertRaisesMessage(CommandError, 'line 2'):
+            self.import_('{"model": "voice", "id": 9, "fields": {}}\n'
+                         '{"model": "missing"}\n')
+        self.assertFalse(Voice.objects.filter(pk=9).exists())
+
+
+@twilio_test_settings
+class HistoryExportTestCase(TestCase):
+    def setUp(self):
+        self.number = TwilioNumber.objects.create(name='office',
+                                                  phone='720-201-0123')
+        self.mailbox = MailboxNumber.objects.create(name='sales')
+        self.now = timezone.now()
+        SmsMessage.objects.bulk_create([
+            SmsMessage(sid='SM{}'.format(i), from_phone='+13035550100',
+                       to_phone='+17202010123' if i % 2 else '+17202010999',
+                       to_phone_e164='+17202010123' if i % 2 else
+                       '+17202010999', message='Hi {}'.format(i),
+                       status='received',
+                       last_activity=self.now - timedelta(days=i // 3))
+            for i in range(10)])
+        Voicemail.objects.create(sid='RE1', call_sid='CA1',
+                                 mailbox=self.mailbox,
+                                 from_phone='+13035550100',
+                                 to_phone='+17202010123', status='completed',
+                                 last_activity=self.now)
+        Voicemail.objects.create(sid='RE2', call_sid='CA2',
+                                 from_phone='+13035550100',
+                                 to_phone='+17202010123', status='completed',
+                                 last_activity=self.now)
+        self.user = User.objects.create_user('staff', password='pw')
+
+    def test_keyset_batches(self):
+        with mock.patch('twilio_call_center.history.batch_size', 3):
+            rows = list(iter_history(history_queryset('sms')))
+        self.assertEqual([row['sid'] for row in rows],
+                         ['SM{}'.format(i) for i in [9, 6, 7, 8, 3, 4, 5,
+                                                    0, 1, 2]])
+
+    def test_filters(self):
+        rows = iter_history(history_queryset(
+                'sms', twilio_number=self.number.pk,
+                start=self.now - timedelta(days=1, hours=1)))
+        self.assertEqual(sorted(row['sid'] for row in rows),
+                         ['SM1', 'SM3', 'SM5'])
+        rows = iter_history(history_queryset('voicemail',
+                                             mailbox=self.mailbox.pk))
+        self.assertEqual([row['mailbox__name'] for row in rows], ['sales'])
+        with self.assertRaises(ValueError):
+            history_queryset('sms', mailbox=self.mailbox.pk)
+
+    def test_requires_permission(self):
+        self.client.login(username='staff', password='pw')
+        response = self.client.get('/call-center/history/sms')
+        self.assertEqual(response.status_code, 403)
+
+    def test_streams_csv_and_ndjson(self):
+        self.user.user_permissions.add(
+                Permission.objects.get(codename='view_voicemail'))
+        self.client.login(username='staff', password='pw')
+        response = self.client.get('/call-center/history/voicemail')
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('id,sid,call_sid,mailbox_id'))
+
+        response = self.client.get('/call-center/history/voicemail',
+                                   {'format': 'ndjson', 'end': 'tomorrow'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/call-center/history/voicemail',
+                                   {'format': 'ndjson',
+                                    'mailbox': self.mailbox.pk})
+        rows = [json.loads(line) for line in
+                b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([row['sid'] for row in rows], ['RE1'])
+
+    def test_command(self):
+        output = StringIO()
+        call_command('export_history', 'sms', '--format', 'ndjson',
+                     '--twilio-number', str(self.number.pk), stdout=output)
+        self.assertEqual(len(output.getvalue().splitlines()), 5)
+
+
+class QueryPlanTestCase(TestCase):
+    ''' Checks that the hot path queries are answered from an index.'''
+    def setUp(self):
+        if connection.vendor not in ['sqlite', 'postgresql']:
+            self.skipTest('No query plan check for ' + connection.vendor)
+        if connection.vendor == 'postgresql':
+            # the test tables are tiny, a sequential scan would always win
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn(index, plan)
+        self.assertNotIn('Seq Scan', plan)
+
+    def test_menu(self):
+        # the index of the unique name constraint
+        index = {
+            'sqlite': 'USING INDEX sqlite_autoindex_twilio_call_center_menu_',
+            'postgresql': 'using twilio_call_center_menu_name_',
+        }[connection.vendor]
+        self.assertUsesIndex(Menu.objects.filter(enabled=True, name='main'),
+                             index)
+
+    def test_menu_items(self):
+        menu = Menu.objects.create(name='main')
+        self.assertUsesIndex(
+                MenuItem.objects.filter(enabled=True, menu=menu)
+                .order_by('menu_digit', 'pk'),
+                'tcc_menuitem_menu_digit_idx')
+
+    def test_expired_voicemails(self):
+        self.assertUsesIndex(
+                Voicemail.objects.filter(removed_from_twilio=False,
+                                         last_activity__lte=timezone.now())
+                .order_by('last_activity', 'pk'),
+                'tcc_voicemail_unremoved_idx')
+
+    def test_history(self):
+        now = timezone.now()
+        for model, index in [(SmsMessage, 'tcc_smsmessage_activity_idx'),
+                             (Voicemail, 'tcc_voicemail_activity_idx')]:
+            self.assertUsesIndex(
+                    model.objects.filter(Q(last_activity__gt=now) |
+                                         Q(last_activity=now, id__gt=1))
+                    .order_by('last_activity', 'id'), index)
+
+    def test_pending_notifications(self):
+        self.assertUsesIndex(
+                Notification.objects.filter(status=Notification.PENDING,
+                                            next_attempt__lte=timezone.now())
+                .order_by('next_attempt'),
+                'twilio_call_status_')
+
+
+class RetentionSweeperTestCase(TestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.archive_dir.cleanup)
+        now = timezone.now()
+        SmsMessage.objects.bulk_create([
+            SmsMessage(sid='SM{}'.format(i), from_phone='+13035550100',
+                       to_phone='+17202010123', message='Hi',
+                       status='delivered',
+                       last_activity=now - timedelta(days=i))
+            for i in range(10)])
+        for sid, removed in [('RE1', True), ('RE2', False)]:
+            Voicemail.objects.create(sid=sid, call_sid='CA' + sid,
+                                     from_phone='+13035550100',
+                                     to_phone='+17202010123',
+                                     status='completed',
+                                     removed_from_twilio=removed,
+                                     last_activity=now - timedelta(days=40))
+        self.sweeper = RetentionSweeper({'sms': 5, 'voicemail': 30},
+                                        self.archive_dir.name)
+        self.sweeper.batch_size = 2
+
+    def archived(self, kind):
+        rows = []
+        for name in sorted(os.listdir(self.archive_dir.name)):
+            if name.startswith(kind):
+                with gzip.open(os.path.join(self.archive_dir.name, name),
+                               'rt') as f:
+                    rows += [json.loads(line)['sid'] for line in f]
+        return rows
+
+    @override_settings(TWILIO_CALL_CENTER_VOICEMAIL_LIFESPAN=7)
+    def test_archives_expired_rows(self):
+        self.assertEqual(self.sweeper.run(), {'sms': 5, 'voicemail': 1})
+        self.assertEqual(self.archived('sms'),
+                         ['SM9', 'SM8', 'SM7', 'SM6', 'SM5'])
+        self.assertEqual(SmsMessage.objects.count(), 5)
+        # the recording of RE2 is not deleted from twilio yet
+        self.assertEqual(self.archived('voicemail'), ['RE1'])
+        self.assertEqual(list(Voicemail.objects.values_list('sid', flat=True)),
+                         ['RE2'])
+
+    def test_settings(self):
+        self.assertIsNone(RetentionSweeper.from_settings())
+        with self.settings(TWILIO_CALL_CENTER_SMS_RETENTION=30):
+            with self.assertRaises(ImproperlyConfigured):
+                RetentionSweeper.from_settings()
+            with self.settings(TWILIO_CALL_CENTER_ARCHIVE_DIR='/archive'):
+                sweeper = RetentionSweeper.from_settings()
+        self.assertEqual(sweeper.days, {'sms': 30})
+
+
+@twilio_test_settings
+class SmsUpsertTestCase(TestCase):
+    def callback(self, sid, status, **data):
+        data.update(MessageSid=sid, From='+17202010123', To='+13035550100',
+                    SmsStatus=status, MessageStatus=status)
+        return self.client.post('/call-center/send-sms-cb', data)
+
+    def message(self, sid, status, body='Hello'):
+        return dict(sid=sid, from_phone='720-201-0123',
+                    to_phone='+13035550100', message=body, status=status,
+                    last_activity=timezone.now())
+
+    def test_callbacks_in_one_query(self):
+        with self.assertNumQueries(1):
+            self.callback('SM1', 'queued', Body='Hello')
+        self.callback('SM1', 'delivered')
+        self.callback('SM1', 'sent')
+        message = SmsMessage.objects.get()
+        self.assertEqual(message.status, 'delivered')
+        self.assertEqual(message.message, 'Hello')
+        self.assertEqual(message.from_phone_e164, '+17202010123')
+
+    def test_full_update_keeps_final_status(self):
+        self.callback('SM1', 'delivered')
+        self.assertEqual(SmsMessage.objects.get().message, 'unknown')
+        upsert_sms_messages([self.message('SM1', 'queued')])
+        message = SmsMessage.objects.get()
+        self.assertEqual(message.status, 'delivered')
+        self.assertEqual(message.message, 'Hello')
+
+    def test_batch(self):
+        upsert_sms_messages([self.message('SM1', 'queued')])
+        with self.assertNumQueries(1):
+            upsert_sms_messages([self.message('SM1', 'sent'),
+                                 self.message('SM2', 'queued'),
+                                 self.message('SM1', 'delivered'),
+                                 self.message('SM1', 'sending')],
+                                status_only=True)
+        self.assertEqual(dict(SmsMessage.objects.values_list('sid', 'status')),
+                         {'SM1': 'delivered', 'SM2': 'queued'})
+
+    def test_fallback(self):
+        with mock.patch.object(connection.features,
+                               'supports_update_conflicts_with_target',
+                               False):
+            upsert_sms_messages([self.message('SM1', 'delivered')])
+            upsert_sms_messages([self.message('SM1', 'sent', body='Hi'),
+                                 self.message('SM2', 'queued')])
+        self.assertEqual(dict(SmsMessage.objects.values_list('sid', 'status')),
+                         {'SM1': 'delivered', 'SM2': 'queued'})
+        self.assertEqual(SmsMessage.objects.get(sid='SM1').message, 'Hi')
+
+
+@twilio_test_settings
+class SmsStatusBufferTestCase(TestCase):
+    def message(self, sid, status):
+        return dict(sid=sid, from_phone='720-201-0123',
+                    to_phone='+13035550100', message='unknown',
+                    status=status, last_activity=timezone.now())
+
+    def test_coalesces_until_flush(self):
+        buffer = SmsStatusBuffer(60, 100)
+        self.addCleanup(buffer.take)
+        for status in ['queued', 'delivered', 'sent']:
+            buffer.add(self.message('SM1', status))
+        buffer.add(self.message('SM2', 'queued'))
+        self.assertEqual(len(buffer), 2)
+        self.assertEqual(SmsMessage.objects.count(), 0)
+        with self.assertNumQueries(1):
+            self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(dict(SmsMessage.objects.values_list('sid', 'status')),
+                         {'SM1': 'delivered', 'SM2': 'queued'})
+
+    def test_overflow_writes_synchronously(self):
+        buffer = SmsStatusBuffer(60, 2)
+        buffer.add(self.message('SM1', 'queued'))
+        buffer.add(self.message('SM2', 'queued'))
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(SmsMessage.objects.count(), 2)
+
+    def test_failed_write_is_kept(self):
+        buffer = SmsStatusBuffer(60, 100)
+        self.addCleanup(buffer.take)
+        buffer.add(self.message('SM1', 'delivered'))
+        buffer.add(self.message('SM2', 'queued'))
+        with mock.patch('twilio_call_center.sms_buffer.upsert_sms_messages',
+                        side_effect=RuntimeError('database is down')):
+            with self.assertRaises(RuntimeError):
+                buffer.flush()
+        self.assertEqual(len(buffer), 2)
+        buffer.add(self.message('SM1', 'sent'))
+        buffer.add(self.message('SM2', 'sent'))
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(dict(SmsMessage.objects.values_list('sid', 'status')),
+                         {'SM1': 'delivered', 'SM2': 'sent'})
+
+    def test_callback_view_buffers(self):
+        buffer = SmsStatusBuffer(60, 100)
+        self.addCleanup(buffer.take)
+        with mock.patch('twilio_call_center.views.sms_status_buffer',
+                        return_value=buffer):
+            with self.assertNumQueries(0):
+                response = self.client.post('/call-center/send-sms-cb', {
+                    'MessageSid': 'SM1', 'SmsStatus': 'sent',
+                    'MessageStatus': 'sent'})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(len(buffer), 1)
+
+
+class FakeTwilioMessages:
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.sent = []
+
+    def create(self, body, to, from_, status_callback):
+        if to in self.fail:
+            raise TwilioRestException(400, 'uri', code=21211)
+        self.sent.append((to, body))
+        return SimpleNamespace(sid='SM' + to[1:], body=body, status='queued')
+
+
+@twilio_test_settings
+@override_settings(TWILIO_CALL_CENTER_CAMPAIGN_RATE=None)
+class SmsCampaignTestCase(TestCase):
+    def setUp(self):
+        self.number = TwilioNumber.objects.create(name='office',
+                                                  phone='+17202010123')
+        self.campaign = SmsCampaign.objects.create(
+                name='spring', twilio_number=self.number,
+                body='Hi {{ name }} & welcome', status=SmsCampaign.SENDING,
+                callback_site='https://example.com')
+        self.messages = FakeTwilioMessages(fail=['+13035550102'])
+        patcher = mock.patch('twilio_call_center.campaigns.twilio_client',
+                             mock.Mock(messages=self.messages))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def statuses(self):
+        return dict(self.campaign.recipients.values_list('phone', 'status'))
+
+    def test_csv_upload(self):
+        User.objects.create_superuser('admin', password='pw')
+        self.client.login(username='admin', password='pw')
+        csv_file = SimpleUploadedFile(
+                'list.csv', b'Phone,Name\n303-555-0100,Ann\nnope,Bob\n'
+                            b'303-555-0100,Ann\n(303) 555-0101,Cat\n')
+        response = self.client.post(
+                '/admin/twilio_call_center/smscampaign/add/',
+                {'name': 'fall', 'twilio_number': self.number.pk,
+                 'body': 'Hello {{ name }}', 'recipients_csv': csv_file})
+        self.assertEqual(response.status_code, 302)
+        campaign = SmsCampaign.objects.get(name='fall')
+        self.assertEqual(campaign.status, SmsCampaign.DRAFT)
+        self.assertEqual(
+            list(campaign.recipients.order_by('phone')
+                 .values_list('phone', 'context')),
+            [('+13035550100', {'name': 'Ann'}),
+             ('+13035550101', {'name': 'Cat'})])
+
+        response = self.client.post(
+                '/admin/twilio_call_center/smscampaign/add/',
+                {'name': 'bad', 'twilio_number': self.number.pk,
+                 'body': 'Hello', 'recipients_csv': SimpleUploadedFile(
+                     'list.csv', b'name\nAnn\n')})
+        self.assertContains(response, 'needs a phone column')
+
+    def test_duplicates_not_counted(self):
+        self.assertEqual(add_recipients(self.campaign, [
+            {'phone': '303-555-0100'}, {'phone': '(303) 555-0100'},
+            {'phone': 'nope'}]), (1, ['nope']))
+        self.assertEqual(add_recipients(self.campaign, [
+            {'phone': '303-555-0100'}, {'phone': '303-555-0101'}]),
+            (1, []))
+
+    def test_sends_in_batches(self):
+        add_recipients(self.campaign, [
+            {'phone': '303-555-01{:02}'.format(i), 'name': str(i)}
+            for i in range(5)])
+        sender = CampaignSender()
+        sender.batch_size = 2
+        with self.assertLogs('twilio_call_center.campaigns', 'ERROR'):
+            sender.run()
+        self.assertEqual(len(self.messages.sent), 4)
+        self.assertIn(('+13035550100', 'Hi 0 & welcome'), self.messages.sent)
+        self.assertEqual(list(self.statuses().values()).count('sent'), 4)
+        self.assertEqual(self.statuses()['+13035550102'], 'failed')
+        self.campaign.refresh_from_db()
+        self.assertEqual(self.campaign.status, SmsCampaign.COMPLETED)
+        self.assertEqual(SmsMessage.objects.filter(status='queued').count(), 4)
+
+    @override_settings(TWILIO_CALL_CENTER_CAMPAIGN_RATE=0.01)
+    def test_batch_fits_in_lease(self):
+        self.assertEqual(CampaignSender().batch_limit(), 3)
+        with override_settings(TWILIO_CALL_CENTER_CAMPAIGN_RATE=None):
+            self.assertEqual(CampaignSender().batch_limit(), 100)
+
+    def test_stops_without_lease(self):
+        add_recipients(self.campaign, [{'phone': '303-555-0100'}])
+        sender = CampaignSender()
+        with self.assertLogs('twilio_call_center.campaigns', 'ERROR'):
+            sender.send_from(self.number.pk)
+        self.assertEqual(self.messages.sent, [])
+        self.assertEqual(self.statuses()['+13035550100'], 'pending')
+
+    def test_pause_and_resume(self):
+        add_recipients(self.campaign, [{'phone': '303-555-0100'},
+                                       {'phone': '303-555-0101'},
+                                       {'phone': '303-555-0103'}])
+        # left sending by a worker that died, it is never sent again
+        self.campaign.recipients.filter(phone='+13035550100').update(
+                status=SmsCampaignRecipient.SENDING)
+        pause_campaign(self.campaign)
+        CampaignSender().run()
+        self.assertEqual(self.messages.sent, [])
+
+        SmsCampaign.objects.filter(pk=self.campaign.pk).update(
+                status=SmsCampaign.SENDING)
+        CampaignSender().run()
+        self.assertEqual([to for to, _ in self.messages.sent],
+                         ['+13035550101', '+13035550103'])
+        self.assertEqual(self.statuses()['+13035550100'], 'failed')
@@ -1,17 +1,35 @@
 import phonenumbers
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseForbidden, \
+    HttpResponseNotAllowed
+from django.views.decorators.csrf import csrf_exempt
+
+from .instrumentation import install_twilio_hook, instrument_view
 
 try:
     from django_twilio.client import twilio_client
-    from django_twilio.decorators import twilio_view
+    from django_twilio.decorators import twilio_view as _twilio_view
+    from django_twilio.settings import TWILIO_AUTH_TOKEN
+    from django_twilio.utils import get_blacklisted_response
+    from twilio.request_validator import RequestValidator
+    from twilio.twiml import TwiML
+    install_twilio_hook(twilio_client)
 except Exception as e:
     print(e)
     print("WARNING: Could not start twilio, it's functions will be disabled")
 
     twilio_client = None
 
-    def twilio_view(fn):
+    def _twilio_view(fn):
         def twilio_disabled(req):
             resp = 'Cannot open {}. Twilio is disabled'.format(fn.__name__)
             if settings.DEBUG:
@@ -20,6 +38,147 @@ except Exception as e:
             return HttpResponse(resp)
         return twilio_disabled
 
+    def _async_twilio_view(fn):
+        async def twilio_disabled(req, *args, **kwargs):
+            return HttpResponse(
+                    'Cannot open {}. Twilio is disabled'.format(fn.__name__))
+        return twilio_disabled
+else:
+    def forged_request_response(request):
+        ''' The forgery check of django_twilio's twilio_view, returns the
+        response rejecting the request or None.'''
+        use_forgery_protection = getattr(
+            settings, 'DJANGO_TWILIO_FORGERY_PROTECTION', not settings.DEBUG)
+        if not use_forgery_protection:
+            return None
+        if request.method not in ['GET', 'POST']:
+            return HttpResponseNotAllowed(request.method)
+        try:
+            validator = RequestValidator(TWILIO_AUTH_TOKEN)
+            url = request.build_absolute_uri()
+            signature = request.headers['x-twilio-signature']
+        except (AttributeError, KeyError):
+            return HttpResponseForbidden()
+        params = request.POST if request.method == 'POST' else request.GET
+        if not validator.validate(url, params, signature):
+            return HttpResponseForbidden()
+        return None
+
+    def _async_twilio_view(fn):
+        ''' django_twilio's twilio_view for async views. The blacklist lookup
+        runs in a thread, the view runs in the event loop.'''
+        @csrf_exempt
+        @wraps(fn)
+        async def decorator(request, *args, **kwargs):
+            response = forged_request_response(request)
+            if response is not None:
+                return response
+            if getattr(settings, 'DJANGO_TWILIO_BLACKLIST_CHECK', True):
+                response = await sync_to_async(get_blacklisted_response)(
+                        request)
+                if response:
+                    return response
+
+            response = await fn(request, *args, **kwargs)
+            if isinstance(response, (str, bytes)):
+                return HttpResponse(response, content_type='application/xml')
+            elif isinstance(response, TwiML):
+                return HttpResponse(str(response),
+                                    content_type='application/xml')
+            return response
+        return decorator
+
+
+def twilio_view(fn):
+    return instrument_view(_twilio_view(fn), fn.__name__)
+
+
+def async_twilio_view(fn):
+    return instrument_view(_async_twilio_view(fn), fn.__name__)
+
+
+class RateLimiter:
+    ''' Spaces out calls from any number of threads to at most rate per
+    second. A rate of None does not limit.'''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+_fan_out_lock = threading.Lock()
+_fan_out_executor = None
+_account_semaphores = {}
+
+
+def twilio_concurrency():
+    return getattr(settings, 'TWILIO_CALL_CENTER_TWILIO_CONCURRENCY', 5)
+
+
+def get_fan_out_executor():
+    global _fan_out_executor
+    with _fan_out_lock:
+        if _fan_out_executor is None:
+            pool_size = twilio_concurrency()
+            # let the threads share one connection pool, large enough that
+            # none of them open a throw away connection
+            session = getattr(getattr(twilio_client, 'http_client', None),
+                              'session', None)
+            if session is not None:
+                from requests.adapters import HTTPAdapter
+                session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+            _fan_out_executor = ThreadPoolExecutor(
+                    max_workers=pool_size,
+                    thread_name_prefix='twilio_fan_out')
+        return _fan_out_executor
+
+
+def account_semaphore(account_sid):
+    with _fan_out_lock:
+        if account_sid not in _account_semaphores:
+            _account_semaphores[account_sid] = threading.BoundedSemaphore(
+                    twilio_concurrency())
+        return _account_semaphores[account_sid]
+
+
+def twilio_fan_out(func, items, account_sid=None, rate_limiter=None):
+    ''' Calls func(item) for each item concurrently, with at most
+    TWILIO_CALL_CENTER_TWILIO_CONCURRENCY calls at once for the twilio account.
+
+    The calling thread waits for rate_limiter before submitting each item,
+    so a slow rate never holds a thread or a slot of the shared pool.
+
+    Returns a list of (result, exception) tuples in the order of items.'''
+    if account_sid is None:
+        account_sid = getattr(twilio_client, 'account_sid', None)
+    semaphore = account_semaphore(account_sid)
+
+    def call(item):
+        with semaphore:
+            try:
+                return func(item), None
+            except Exception as e:
+                return None, e
+
+    if rate_limiter is None:
+        return list(get_fan_out_executor().map(call, items))
+    futures = []
+    for item in items:
+        rate_limiter.wait()
+        futures.append(get_fan_out_executor().submit(call, item))
+    return [future.result() for future in futures]
+
 
 def split_csv_list(csv_list):
     return list(map(str.strip, csv_list.split(',')))
@@ -34,13 +193,60 @@ def split_list_or_empty(csv_list):
         return split_csv_list(csv_list)
 
 
+phone_cache_size = 4096
+
+
+def default_country():
+    return getattr(settings, 'TWILIO_CALL_CENTER_DEFAULT_COUNTRY', 'US')
+
+
+@lru_cache(maxsize=phone_cache_size)
+def _parse_phone_number(number, country):
+    return phonenumbers.parse(number, country)
+
+
+@lru_cache(maxsize=phone_cache_size)
+def _normalize_phone_number(number, country):
+    try:
+        return phonenumbers.format_number(_parse_phone_number(number, country),
+                                          phonenumbers.PhoneNumberFormat.E164)
+    except:
+        return ''
+
+
 def parse_phone_number(number):
     ''' Parse the string argument into a PhoneNumber.
 
+    Results are cached, so the returned PhoneNumber must not be modified.
     May raise a NumberParseException per phonenumbers.parse() function.'''
-    default_country = getattr(settings,
-                              'TWILIO_CALL_CENTER_DEFAULT_COUNTRY', 'US')
-    return phonenumbers.parse(number, default_country)
+    return _parse_phone_number(number, default_country())
+
+
+def normalize_phone_number(number):
+    ''' Returns the E.164 string for the phone number, or '' if the number
+    does not parse.'''
+    if not number:
+        return ''
+    return _normalize_phone_number(number, default_country())
+
+
+def phone_cache_info():
+    ''' Returns the hit/miss statistics of the phone number caches.'''
+    return {
+        'parse': _parse_phone_number.cache_info()._asdict(),
+        'normalize': _normalize_phone_number.cache_info()._asdict(),
+    }
+
+
+def clear_phone_cache():
+    _parse_phone_number.cache_clear()
+    _normalize_phone_number.cache_clear()
+
+
+@receiver(setting_changed)
+def phone_setting_changed(setting, **kwargs):
+    if setting == 'TWILIO_CALL_CENTER_DEFAULT_COUNTRY':
+        clear_phone_cache()
 
 
 def phone_numbers_equal(n1, n2):
@@ -1,17 +1,18 @@
 import logging
 import re
 
-from apscheduler.jobstores.base import JobLookupError
 from datetime import timedelta
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.sites.shortcuts import get_current_site
-from django.core.mail import send_mail
-from django.http import Http404, HttpResponse, JsonResponse
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, \
+    JsonResponse, StreamingHttpResponse
+from django.template.loader import get_template
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
 from django.utils.formats import localize
-from django.utils.html import strip_tags, escape
+from django.utils.html import escape
 from django.utils.safestring import SafeText
 from django.views.generic.edit import FormView
 
@@ -20,12 +21,19 @@ from django.views.generic.edit import FormView
 from twilio.twiml.voice_response import VoiceResponse
 from twilio.twiml.messaging_response import MessagingResponse
 
+from .actions import not_started, pending
 from .apps import my_app
+from .cache import find_twilio_number, get_compiled_menu, menu_cache
 from .forms import SendSmsForm
-from .models import Menu, MenuItem, Voicemail, twilio_default_transfer, \
-    twilio_default_voice, SmsMessage, TwilioNumber
-from .schedule import scheduler
-from .utils import twilio_client, twilio_view, phone_numbers_equal
+from .history import content_types, history_kinds, history_queryset, \
+    parse_time, render_history
+from .models import Notification, Voicemail, twilio_default_transfer, \
+    SmsMessage
+from .notifications import cancel_notifications, enqueue_email, \
+    enqueue_notification, enqueue_sms
+from .sms_buffer import sms_status_buffer
+from .sms_upsert import upsert_sms_messages
+from .utils import twilio_client, twilio_view
 
 
 logger = logging.getLogger(__name__)
@@ -58,11 +66,7 @@ class FormViewWithErrorDisplay(FormView):
 
 
 def twilio_say(menu, response, message, **kwargs):
-    if menu.voice is None:
-        voice = twilio_default_voice
-    else:
-        voice = menu.voice.voice
-    response.say(message, voice=voice, **kwargs)
+    response.say(message, voice=menu.voice, **kwargs)
 
 
 def get_query_dict(request):
@@ -92,24 +96,27 @@ def voicemail_sms_reverse(name, digit):
 
 
 def get_menu(name):
-    menu = Menu.objects.filter(enabled=True, name=name)
-    if len(menu) == 0:
+    menu = get_compiled_menu(name)
+    if menu is None:
         raise Http404("Call Center menu {} doesn't exist.".format(name))
 
-    return menu.first()
+    return menu
 
 
 def get_menu_items(menu):
-    items = MenuItem.objects.filter(enabled=True, menu=menu) \
-        .order_by('menu_digit')
-    if len(items) == 0:
+    if len(menu.items) == 0:
         raise Http404("Call Center menu {} has no items.".format(menu.name))
 
-    return items
+    return menu.items
 
 
-@twilio_view
-def call_menu(request, name):
+def cached_twiml(key, render):
+    ''' Returns the serialized TwiML for key, it is only rendered once for
+    each version of the menu cache.'''
+    return menu_cache.get(('twiml',) + key, lambda: str(render()).encode())
+
+
+def render_call_menu(name):
     response = VoiceResponse()
     menu = get_menu(name)
     items = get_menu_items(menu)
@@ -142,15 +149,86 @@ def call_menu(request, name):
 
 
 @twilio_view
-def call_action(request, name, digit=None):
-    ''' Takes both action and pin urls
-        <name>/call-action
-        <name>/call-pin/<digit>
-    '''
+def call_menu(request, name):
+    return cached_twiml(('call-menu', name), lambda: render_call_menu(name))
+
+
+def render_pin_prompt(name, digit):
     response = VoiceResponse()
     menu = get_menu(name)
-    items = get_menu_items(menu)
-    pin = None
+    item = menu.get_item(digit)
+    with response.gather(
+        finish_on_key='#', action=pin_reverse(name, digit),
+        method="POST", timeout=10
+    ) as g:
+        pin_text = "Enter your pin followed by pound."
+        if item.pin_text:
+            pin_text = item.pin_text
+        twilio_say(menu, g, pin_text)
+    return response
+
+
+def render_invalid_entry(name):
+    response = VoiceResponse()
+    menu = get_menu(name)
+    twilio_say(menu, response, 'Invalid entry.')
+    response.pause(1)
+    response.redirect(call_reverse(name, 'call-menu'))
+    return response
+
+
+def call_poll_reverse(name, digit):
+    return call_reverse(name, 'call-poll', digit=digit)
+
+
+def render_action_hold(menu, func, name, digit, poll):
+    response = VoiceResponse()
+    if not poll:
+        twilio_say(menu, response, func.policy['hold'] + '.')
+    response.pause(func.policy['poll'])
+    response.redirect(call_poll_reverse(name, digit))
+    return response
+
+
+def render_background_result(menu, item, name, action_text):
+    response = VoiceResponse()
+    if not action_text:
+        action_text = item.action_text or None
+    if action_text:
+        twilio_say(menu, response, action_text + '.')
+        response.pause(1)
+    if item.action_url:
+        response.redirect(item.action_url)
+    else:
+        response.redirect(call_reverse(item.action_submenu or name,
+                                       'call-menu'))
+    return response
+
+
+def render_call_poll(request, name, digit):
+    ''' Only answers for a background action function which call_action
+    started for this call and digit, so the poll url never runs an action
+    on its own.'''
+    menu = get_menu(name)
+    item = menu.get_item(digit)
+    func = None
+    if item is not None and item.action_function:
+        func = my_app().action_functions.get(item.action_function, None)
+    if not getattr(func, 'background', False):
+        raise Http404("Call Center menu {} item {} has no background "
+                      "action.".format(name, digit))
+    result = func.poll(request, item.menu_digit)
+    if result is not_started:
+        raise Http404("No background action was started for the call.")
+    if result is pending:
+        return render_action_hold(menu, func, name, item.menu_digit, True)
+    return render_background_result(menu, item, name, result)
+
+
+def render_call_action(request, name, digit):
+    response = VoiceResponse()
+    menu = get_menu(name)
+    item = menu.get_item(digit)
     action_text = None
     action_phone = None
     action_voicemail = None
@@ -159,35 +237,7 @@ def call_action(request, name, digit=None):
     next_menu = name
     next_page = None
 
-    query_dict = get_query_dict(request)
-    if digit is None:
-        digit = query_dict['Digits']
-    else:
-        pin = query_dict['Digits']
-
-    digit_items = items.filter(menu_digit=digit)
-    if len(digit_items):
-        item = digit_items.first()
-
-        pin_digits_list = item.get_pin_digits_list()
-        if len(pin_digits_list):
-            if pin is None:
-                with response.gather(
-                    finish_on_key='#', action=pin_reverse(name, digit),
-                    method="POST", timeout=10
-                ) as g:
-                    pin_text = "Enter your pin followed by pound."
-                    if item.pin_text:
-                        pin_text = item.pin_text
-                    twilio_say(menu, g, pin_text)
-                return response
-            else:
-                if pin not in pin_digits_list:
-                    twilio_say(menu, response, 'Invalid entry.')
-                    response.pause(1)
-                    response.redirect(call_reverse(name, 'call-menu'))
-                    return response
-
+    if item is not None:
         if item.action_text:
             action_text = item.action_text
         if item.action_mailbox:
@@ -205,14 +255,20 @@ def call_action(request, name, digit=None):
         if item.action_url:
             action_url = item.action_url
         elif item.action_submenu:
-            next_menu = item.action_submenu.name
+            next_menu = item.action_submenu
             next_page = "call-menu"
         if item.action_function:
             action_function = item.action_function
 
     if action_function is not None:
         func = my_app().action_functions.get(action_function, None)
-        if func is not None:
+        if getattr(func, 'background', False):
+            func_str = func.start(request, digit)
+            if func_str is pending:
+                return render_action_hold(menu, func, name, digit, False)
+            if func_str is not None:
+                action_text = func_str
+        elif func is not None:
             func_str = func(request=request, response=response)
             if func_str is not None:
                 action_text = func_str
@@ -240,7 +296,49 @@ def call_action(request, name, digit=None):
 
 
 @twilio_view
-def call_end(request, name):
+def call_action(request, name, digit=None):
+    ''' Takes both action and pin urls
+        <name>/call-action
+        <name>/call-pin/<digit>
+    '''
+    menu = get_menu(name)
+    get_menu_items(menu)
+    pin = None
+
+    query_dict = get_query_dict(request)
+    if digit is None:
+        digit = query_dict['Digits']
+    else:
+        pin = query_dict['Digits']
+
+    item = menu.get_item(digit)
+    if item is None:
+        return cached_twiml(('call-action', name, None),
+                            lambda: render_call_action(request, name, None))
+
+    digit = item.menu_digit
+    if len(item.pin_digits_list):
+        if pin is None:
+            return cached_twiml(('call-pin', name, digit),
+                                lambda: render_pin_prompt(name, digit))
+        if pin not in item.pin_digits_list:
+            return cached_twiml(('invalid-entry', name),
+                                lambda: render_invalid_entry(name))
+
+    # mailbox availability and action functions change with each call
+    if item.action_mailbox or item.action_function:
+        return render_call_action(request, name, digit)
+    return cached_twiml(('call-action', name, digit),
+                        lambda: render_call_action(request, name, digit))
+
+
+@twilio_view
+def call_poll(request, name, digit):
+    ''' Twilio is redirected here while a background action function runs.'''
+    return render_call_poll(request, name, digit)
+
+
+def render_call_end(name):
     response = VoiceResponse()
     menu = get_menu(name)
     twilio_say(menu, response, 'Goodbye.')
@@ -248,9 +346,9 @@ def call_end(request, name):
     return response
 
 
-def voicemail_notification_job(recording_sid, current_site):
-    voicemail = Voicemail.objects.get(sid=recording_sid)
-    send_voicemail_notifications(voicemail, current_site)
+@twilio_view
+def call_end(request, name):
+    return cached_twiml(('call-end', name), lambda: render_call_end(name))
 
 
 def send_voicemail_notifications(voicemail, current_site):
@@ -262,32 +360,21 @@ def send_voicemail_notifications(voicemail, current_site):
     if len(email_list) == 0 and len(phone_list) == 0:
         return
 
-    html = '''Hello,<br>
-<br>
-Call center option [{menu_item}] mailbox [{mailbox}] received voicemail from {from_phone}.<br>
-<br>
-Recording is at {url}'''.format(menu_item=voicemail.menu_item,
-                                mailbox=mailbox,
-                                from_phone=voicemail.from_phone,
-                                url=voicemail.url)
-
-    if voicemail.transcription_status:
-        html += '''<br>
-<br>
-Transcription {}'''.format(voicemail.transcription_status)
-        if voicemail.transcription_status == 'completed':
-            html += ''':<br>
-'''
-            html += voicemail.transcription
-
-    text_message = strip_tags(html)
+    text_message, html = render_email(
+        'twilio_call_center/voicemail_email', dict(
+        menu_item=voicemail.menu_item,
+        mailbox=mailbox,
+        from_phone=voicemail.from_phone,
+        url=voicemail.url,
+        transcription_status=voicemail.transcription_status,
+        transcription=voicemail.transcription))
     if len(email_list):
-        send_mail('Received {} voicemail from {}'.format(voicemail.menu_item,
-                                                         voicemail.from_phone),
-                  text_message,
-                  settings.TWILIO_CALL_CENTER_VOICEMAIL_EMAIL,
-                  email_list,
-                  html_message=html)
+        enqueue_email('Received {} voicemail from {}'.format(
+                          voicemail.menu_item, voicemail.from_phone),
+                      text_message,
+                      settings.TWILIO_CALL_CENTER_VOICEMAIL_EMAIL,
+                      email_list,
+                      html_message=html)
 
     if len(phone_list):
         callback_site = twilio_callback_site(current_site)
@@ -299,15 +386,12 @@ Transcription {}'''.format(voicemail.transcription_status)
             if menu:
                 name = menu.name
         for to_number in phone_list:
-            kwargs = {
-                'body': text_message,
-                'to': to_number,
-                'from_': mailbox.notification_phone.phone,
-                'status_callback': callback_site + voicemail_sms_reverse(name,
-                                                                         digit),
-            }
-
-            twilio_client.messages.create(**kwargs)
+            enqueue_sms(
+                body=text_message,
+                to=to_number,
+                from_=mailbox.notification_phone.phone,
+                status_callback=callback_site + voicemail_sms_reverse(name,
+                                                                      digit))
 
 
 def handle_sms_cb_status(request, cb_type):
@@ -326,79 +410,78 @@ def voicemail_sms_cb(request, name, digit):
     return handle_sms_cb_status(request, cb_type)
 
 
-@twilio_view
-def voicemail(request, name, digit):
-    query_dict = get_query_dict(request)
-    current_site = get_current_site(request)
-    recording_sid = query_dict['RecordingSid']
-    transcription = query_dict.get('TranscriptionText', None)
-    transcription_status = query_dict.get('TranscriptionStatus', None)
+def render_voicemail_end(name):
+    response = VoiceResponse()
     menu = get_menu(name)
-    items = get_menu_items(menu).filter(menu_digit=digit)
+    twilio_say(menu, response, 'Thanks for the voicemail. Goodbye.')
+    response.hangup()
+    return response
 
+
+def voicemail_defaults(query_dict, menu_item):
     defaults=dict(call_sid=query_dict['CallSid'],
                   from_phone=query_dict['From'],
                   to_phone=query_dict['To'],
                   url=query_dict['RecordingUrl'],
                   status=query_dict['CallStatus'],
                   last_activity=timezone.now())
+    transcription = query_dict.get('TranscriptionText', None)
+    transcription_status = query_dict.get('TranscriptionStatus', None)
     if transcription is not None:
         defaults['transcription'] = transcription
     if transcription_status is not None:
         defaults['transcription_status'] = transcription_status
-    if len(items) > 0:
-        menu_item = items.first()
-        defaults['menu_item'] = menu_item
-        defaults['mailbox'] = menu_item.action_mailbox
+    if menu_item is not None:
+        defaults['menu_item_id'] = menu_item.id
+        mailbox = menu_item.action_mailbox
+        defaults['mailbox_id'] = mailbox.id if mailbox else None
+    return defaults
 
-    voicemail, _ = Voicemail.objects.update_or_create(
-            sid=recording_sid,
-            defaults=defaults)
 
+def queue_voicemail_notification(query_dict, current_site):
     # We need settings.TWILIO_CALL_CENTER_VOICEMAIL_EMAIL, so make sure it
     # exists, else raise an exception which will email admins
     _ = settings.TWILIO_CALL_CENTER_VOICEMAIL_EMAIL
-    job_id = "transcript-" + recording_sid
-    if transcription_status is None:
-        scheduler.add_job(voicemail_notification_job, 'date',
-                          run_date=timezone.now() + timedelta(minutes=5),
-                          args=[recording_sid, current_site], id=job_id)
+    # Wait for the transcription, but notify without it after 5 minutes
+    recording_sid = query_dict['RecordingSid']
+    key = "transcript-" + recording_sid
+    payload = dict(sid=recording_sid, site=str(current_site))
+    if query_dict.get('TranscriptionStatus', None) is None:
+        enqueue_notification(Notification.VOICEMAIL, payload,
+                             delay=timedelta(minutes=5), key=key)
     else:
-        try:
-            scheduler.remove_job(job_id)
-        except JobLookupError:
-            pass
-        send_voicemail_notifications(voicemail, current_site)
+        cancel_notifications(key)
+        enqueue_notification(Notification.VOICEMAIL, payload)
 
-    response = VoiceResponse()
-    twilio_say(menu, response, 'Thanks for the voicemail. Goodbye.')
-    response.hangup()
-    return response
 
+@twilio_view
+def voicemail(request, name, digit):
+    query_dict = get_query_dict(request)
+    current_site = get_current_site(request)
+    menu = get_menu(name)
+    get_menu_items(menu)
 
-def sms_to_email(query_dict, twilio_phone, html):
-    if html:
-        def html_wrap(pre, value="", post=""):
-            return pre + value + post
-    else:
-        def html_wrap(pre, value="", post=""):
-            return value
-    msg = ""
-    msg += html_wrap('<html><body>')
-
-    box_style = "; ".join([
-        'border: thin solid black',
-        'border-radius: 1em',
-        'display: inline-block',
-        'padding: 1em',
-    ])
-    img_style = "; ".join([
-        'max-width: 100%',
-        'max-height: 100%',
-    ])
-    msg += html_wrap('<p><span style="{}">'.format(box_style),
-                     query_dict.get('Body', ''),
-                     '</span></p>')
+    Voicemail.objects.update_or_create(
+            sid=query_dict['RecordingSid'],
+            defaults=voicemail_defaults(query_dict, menu.get_item(digit)))
+    queue_voicemail_notification(query_dict, current_site)
+
+    return cached_twiml(('voicemail-end', name),
+                        lambda: render_voicemail_end(name))
+
+
+def render_email(template_name, context):
+    ''' Renders the .txt and .html templates of an email with one context.
+
+    The compiled templates are kept by django's cached template loader.'''
+    text = get_template(template_name + '.txt').render(context)
+    html = get_template(template_name + '.html').render(context)
+    return text.strip(), html
+
+
+def render_sms_email(query_dict, twilio_phone):
+    ''' Returns the text and html email bodies for an incoming SMS.'''
+    media_list = []
     try:
         num_media = int(query_dict.get('NumMedia', '0'))
         for i in range(num_media):
@@ -407,33 +490,17 @@ def sms_to_email(query_dict, twilio_phone, html):
                 continue
             media_type = query_dict.get(
                 'MediaContentType{}'.format(i), "media")
-            msg += html_wrap('<br />', '\n')
-            if re.match("image/", media_type):
-                msg += html_wrap('<img style="{}" alt="'.format(img_style),
-                                 media_type,
-                                 '" ')
-                if not html:
-                    msg += ' '
-                msg += html_wrap('src="',
-                                 media_url,
-                                 '">')
-            else:
-                if not html:
-                    msg += media_type + " "
-                msg += html_wrap('<a href="',
-                                 media_url,
-                                 '">{}</a>'.format(media_type))
+            media_list.append(dict(url=media_url, type=media_type,
+                                   is_image=media_type.startswith('image/')))
     except:
         logger.error("Could not prepare media for sms to email {}".format(
             query_dict.get('From', 'unknown')))
 
-    msg += html_wrap('<p>',
-                     '\nFrom: {} '.format(query_dict.get('From', 'unknown')))
-    msg += html_wrap('<br />',
-                     '\nTo: {} '.format(twilio_phone),
-                     '</p>')
-    msg += html_wrap('</body></html>')
-    return msg
+    return render_email('twilio_call_center/sms_email', dict(
+        body=query_dict.get('Body', ''),
+        media_list=media_list,
+        from_phone=query_dict.get('From', 'unknown'),
+        twilio_phone=twilio_phone))
 
 
 def sms_forward(current_site, twilio_phone, to_number, query_dict):
@@ -462,7 +529,7 @@ def sms_forward(current_site, twilio_phone, to_number, query_dict):
         logger.error("Could not prepare media for sms forward {}".format(
             query_dict.get('From', 'unknown')))
 
-    twilio_client.messages.create(**kwargs)
+    enqueue_sms(**kwargs)
 
 
 @twilio_view
@@ -470,46 +537,20 @@ def sms_forward_cb(request):
     return handle_sms_cb_status(request, "Forward SMS")
 
 
-@twilio_view
-def sms_incoming(request):
-    query_dict = get_query_dict(request)
-    current_site = get_current_site(request)
-    twilio_phone = None
-    to_number = query_dict.get('To', None)
-    if to_number is None:
-        logger.error("Twilio API call has no 'To' field: " + str(query_dict))
-        return MessagingResponse()
-
-    update_sms_message("Incoming SMS", query_dict)
-
-    for phone in TwilioNumber.objects.all():
-        if phone_numbers_equal(phone.phone, to_number):
-            twilio_phone = phone
-            break
-
-    if twilio_phone is None:
-        logger.error(
-            "Couldn't find matching TwilioNumber for incoming SMS. To: " +
-            to_number)
-        return MessagingResponse()
-
+def forward_incoming_sms(query_dict, current_site, twilio_phone):
     email_to = twilio_phone.get_forward_email_list()
     if len(email_to):
         # We need settings.TWILIO_CALL_CENTER_SMS_EMAIL, so make sure it
         # exists, else raise an exception which will email admins
         _ = settings.TWILIO_CALL_CENTER_SMS_EMAIL
-        try:
-            send_mail('SMS to {} from {}'.
-                            format(current_site,
-                                   query_dict.get('From', 'unknown')),
-                      sms_to_email(query_dict, twilio_phone, False),
+        text_message, html = render_sms_email(query_dict, twilio_phone)
+        enqueue_email('SMS to {} from {}'.
+                          format(current_site,
+                                 query_dict.get('From', 'unknown')),
+                      text_message,
                       settings.TWILIO_CALL_CENTER_SMS_EMAIL,
                       email_to,
-                      html_message=sms_to_email(query_dict, twilio_phone, True),
-                      )
-        except Exception as e:
-            logger.error('Unable to send SMS email to {}'.format(email_to))
-            logger.error(str(e))
+                      html_message=html)
     sms_to = twilio_phone.get_forward_phone_list()
     for to_number in sms_to:
         try:
@@ -517,23 +558,56 @@ def sms_incoming(request):
         except Exception as e:
             logger.error('Unable to forward SMS to {}'.format(to_number))
             logger.error(str(e))
+
+
+def log_unknown_twilio_number(to_number):
+    logger.error(
+        "Couldn't find matching TwilioNumber for incoming SMS. To: " +
+        to_number)
+
+
+@twilio_view
+def sms_incoming(request):
+    query_dict = get_query_dict(request)
+    current_site = get_current_site(request)
+    to_number = query_dict.get('To', None)
+    if to_number is None:
+        logger.error("Twilio API call has no 'To' field: " + str(query_dict))
+        return MessagingResponse()
+
+    update_sms_message("Incoming SMS", query_dict)
+
+    twilio_phone = find_twilio_number(to_number)
+    if twilio_phone is None:
+        log_unknown_twilio_number(to_number)
+        return MessagingResponse()
+
+    forward_incoming_sms(query_dict, current_site, twilio_phone)
     return MessagingResponse()
 
 
-def update_sms_message(type_str, query_dict):
+def update_sms_message(type_str, query_dict, status_only=False):
+    ''' Returns the sid of the created or updated SmsMessage, or None.
+
+    Status updates are only buffered when the SMS callback buffer is
+    enabled, the row may not be written yet when this returns.'''
     sid = query_dict.get('MessageSid', None)
     if not sid:
         logger.warning("{} doesn't have MessageSid".format(type_str))
         return None
     else:
-        msg_kwargs = dict(from_phone=query_dict.get('From', 'unknown'),
-                          to_phone=query_dict.get('To', 'unknown'),
-                          message=query_dict.get('Body', 'unknown'),
-                          status=query_dict.get('SmsStatus', 'unknown'),
-                          last_activity=timezone.now())
-        msg, _ = SmsMessage.objects.update_or_create(sid=sid,
-                                                     defaults=msg_kwargs)
-        return msg
+        message = dict(sid=sid,
+                       from_phone=query_dict.get('From', 'unknown'),
+                       to_phone=query_dict.get('To', 'unknown'),
+                       message=query_dict.get('Body', 'unknown'),
+                       status=query_dict.get('SmsStatus', 'unknown'),
+                       last_activity=timezone.now())
+        buffer = sms_status_buffer() if status_only else None
+        if buffer is not None:
+            buffer.add(message)
+        else:
+            upsert_sms_messages([message], status_only=status_only)
+        return sid
 
 
 def send_sms(current_site, from_number, to_number, msg):
@@ -564,7 +638,7 @@ def send_sms(current_site, from_number, to_number, msg):
     result['status'] = getattr(msg, 'status', 'unknown')
     result['error'] = getattr(msg, 'error_message', None)
 
-    sms_message = update_sms_message("SMS send", dict(
+    sid = update_sms_message("SMS send", dict(
         MessageSid=msg.sid,
         From=getattr(msg, 'from_', 'unknown'),
         To=getattr(msg, 'to', 'unknown'),
@@ -572,8 +646,9 @@ def send_sms(current_site, from_number, to_number, msg):
         SmsStatus=result['status'],
     ))
 
-    if sms_message:
-        result['id'] = sms_message.id
+    if sid:
+        result['id'] = SmsMessage.objects.filter(sid=sid) \
+            .values_list('id', flat=True).first()
 
     return result
 
@@ -581,7 +656,7 @@ def send_sms(current_site, from_number, to_number, msg):
 @twilio_view
 def send_sms_cb(request):
     query_dict = get_query_dict(request)
-    update_sms_message("SMS send callback", query_dict)
+    update_sms_message("SMS send callback", query_dict, status_only=True)
     return handle_sms_cb_status(request, 'Sending SMS')
 
 
@@ -610,6 +685,35 @@ def sms_status(request):
     return JsonResponse(response)
 
 
+def history_export(request, kind):
+    if kind not in history_kinds:
+        raise Http404('Unknown history')
+    model_name = history_kinds[kind][0]._meta.model_name
+    if not request.user.has_perm('twilio_call_center.view_' + model_name):
+        raise PermissionDenied
+
+    query_dict = get_query_dict(request)
+    output_format = query_dict.get('format', 'csv')
+    try:
+        filters = {}
+        for name in ['twilio_number', 'mailbox']:
+            if query_dict.get(name):
+                filters[name] = int(query_dict[name])
+        for name in ['start', 'end']:
+            if query_dict.get(name):
+                filters[name] = parse_time(query_dict[name])
+        chunks = render_history(kind, output_format,
+                                history_queryset(kind, **filters))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    response = StreamingHttpResponse(chunks,
+                                     content_type=content_types[output_format])
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(
+            kind, output_format)
+    return response
+
+
 class SendSmsView(FormViewWithErrorDisplay):
     template_name = 'twilio_call_center/send_sms.html'
     form_class = SendSmsForm